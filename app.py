@@ -1,38 +1,170 @@
-from flask import Flask, render_template, request, redirect, session, url_for, jsonify, abort
+from flask import Flask, render_template, request, redirect, session, url_for, jsonify, abort, send_from_directory, g, has_request_context
 from functools import wraps
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 from datetime import datetime, timezone
-from moviepy.editor import VideoFileClip
 import os, json
-import ffmpeg
+import re
+import shutil
+import mimetypes
+import base64
 import uuid
 import random
 import string
+import atexit
+import threading
+import storage
+import counters
+import search
+import media
+import probe
+import jobs
+import reconcile
+import votes
+import comments
+import notifications
+import roles
+import leaderboard
+import usernames
+import follows
+import feeds
+import click
 
 app = Flask(__name__)
 app.secret_key = "supersecretkey"  # change this
 
 VIDEO_FOLDER = "static/videos"
 THUMB_FOLDER = "static/thumbnails"
-USER_FILE = "users.json"
-ADMIN_FILE = "admins.json"
+HLS_FOLDER = "static/hls"  # one folder of renditions per video
+DB_FILE = "eniv.db"
+# "sqlite" (default) or "json" to keep using the flat json files on small installs
+STORAGE_BACKEND = os.environ.get("ENIV_STORAGE", "sqlite")
+VIEW_FLUSH_INTERVAL = 10  # seconds between view count writes
+VIEW_FLUSH_THRESHOLD = 100  # or write once this many views are pending
+SEARCH_LIMIT = 200  # most results a search returns
+PAGE_SIZE = 24  # videos per page on the home page and /videos
+MAX_PAGE_SIZE = 100
+COMMENTS_PAGE_SIZE = 20  # top level comments on the video page, and replies per fetch
+NOTIFICATIONS_PAGE_SIZE = 50
+NOTIFY_INBOX_LIMIT = 500  # newest notifications kept per user
+NOTIFY_RETENTION_DAYS = 90
+NOTIFY_BATCH_SIZE = 500  # followers notified per write when a video goes out
+NOTIFY_WORKERS = int(os.environ.get("ENIV_NOTIFY_WORKERS") or 1)
+FEED_TIMELINE_LIMIT = 500  # newest videos kept in each following feed
+FEED_FAN_OUT_LIMIT = 5000  # creators with this many followers are merged in at read time instead
+FEED_BACKFILL = 20  # videos of a newly followed creator added to the follower's feed
+# home page sort orders -> indexed video column
+SORT_COLUMNS = {"newest": "uploaded_at", "views": "views", "likes": "likes"}
+# transcode threads per process, and transcodes running at once across all
+# the worker processes sharing the store (one per core by default)
+TRANSCODE_WORKERS = int(os.environ.get("ENIV_TRANSCODE_WORKERS") or os.cpu_count() or 1)
+TRANSCODE_SLOTS = int(os.environ.get("ENIV_TRANSCODE_SLOTS") or os.cpu_count() or 1)
+TRANSCODE_ATTEMPTS = 3  # the last attempt publishes the raw upload if ffmpeg still fails
+UPLOAD_TEMP_FOLDER = "temp"
+# largest upload accepted, bigger ones get a 413 before they're read
+MAX_UPLOAD_BYTES = int(os.environ.get("ENIV_MAX_UPLOAD_BYTES") or 50 * 1024 * 1024)
+UPLOAD_CHUNK_BYTES = 4 * 1024 * 1024  # chunk size suggested to chunked upload clients
+UPLOAD_BLOCK_BYTES = 64 * 1024  # chunks are streamed to disk this much at a time
+UPLOAD_SESSION_TTL = 24 * 3600  # chunked uploads idle this long are dropped
+RECONCILE_INTERVAL = 6 * 3600  # seconds between storage clean ups
+PROFILES_PAGE_SIZE = 48
+FOLLOWS_PAGE_SIZE = 50  # usernames per page of /user/<name>/followers and /following
+LEADERBOARD_RESCORE_INTERVAL = 3600  # seconds between creator score refreshes
+MAX_VIDEO_SECONDS = 1.0
+MAX_VIDEO_DIMENSION = 4096  # longest side in pixels
+# x264 settings for the published mp4, retries drop to RETRY_PRESET
+X264_PRESET = os.environ.get("ENIV_X264_PRESET", "veryfast")
+X264_CRF = int(os.environ.get("ENIV_X264_CRF") or 23)
+RETRY_PRESET = "ultrafast"
+ENCODE_TIME_BUDGET = 60  # seconds an encode may take before it's killed and retried
+# HLS renditions encoded next to the mp4 as (square size, video kbps), sizes
+# at or above the source are skipped. The mp4 itself is added as "source".
+HLS_LADDER = ((240, 400), (480, 1000))
+# hls.js for browsers without native HLS, a pinned release's dist/hls.min.js
+# saved under the static folder. ENIV_HLS_JS_URL can point at a CDN copy
+# instead, only together with its ENIV_HLS_JS_INTEGRITY (sha384-...) so a
+# changed script is refused. With neither, those browsers get the mp4.
+HLS_JS_FILE = "static/vendor/hls.min.js"
+HLS_JS_URL = os.environ.get("ENIV_HLS_JS_URL", "")
+HLS_JS_INTEGRITY = os.environ.get("ENIV_HLS_JS_INTEGRITY", "")
+# /media/<kind>/<file> serves these folders
+MEDIA_FOLDERS = {"videos": VIDEO_FOLDER, "thumbnails": THUMB_FOLDER, "hls": HLS_FOLDER}
+# Who sends the media bytes: "" for Flask itself (range requests, sendfile
+# through the WSGI server's file wrapper), "x-sendfile" for Apache/lighttpd,
+# or "x-accel" for nginx with an internal location at MEDIA_ACCEL_PREFIX
+# aliasing the static folder.
+MEDIA_OFFLOAD = os.environ.get("ENIV_MEDIA_OFFLOAD", "")
+MEDIA_ACCEL_PREFIX = "/_media/"
+MEDIA_IMMUTABLE_AGE = 365 * 24 * 3600
+# published files are named after their content hash, so they never change
+CONTENT_NAME_RE = re.compile(r"^[0-9a-f]{32}\.\w+$")
 
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
 os.makedirs(THUMB_FOLDER, exist_ok=True)
+os.makedirs(HLS_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_TEMP_FOLDER, exist_ok=True)
+
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+app.config["USE_X_SENDFILE"] = MEDIA_OFFLOAD == "x-sendfile"
+
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/mp2t", ".ts")
+
+store = storage.open_store(STORAGE_BACKEND, DB_FILE)
+if store.backend == "sqlite" and not store.get_meta("json_imported"):
+    # first run on sqlite, pull in the existing json files once. Checked
+    # again inside the transaction, another worker may be starting too and
+    # may already have imported and migrated them.
+    with store.transaction():
+        if not store.get_meta("json_imported"):
+            storage.import_json(store)
+
+view_counter = counters.ViewCounter(store.videos, VIEW_FLUSH_INTERVAL, VIEW_FLUSH_THRESHOLD)
+atexit.register(view_counter.flush)
+
+search_index = search.SearchIndex(store.collection("search_terms"))
+vote_store = votes.VoteStore(store.collection("votes"))
+comment_store = comments.CommentStore(store.collection("comments"))
+creator_board = leaderboard.Leaderboard(store.collection("creators"))
+user_index = usernames.UsernameIndex(store.collection("user_names"), store.collection("user_hints"))
+follow_graph = follows.FollowGraph(store.collection("follows"), store.collection("follow_counts"))
+timelines = feeds.Timelines(store.collection("timelines"), store.collection("large_creators"), store.videos,
+                            FEED_TIMELINE_LIMIT, FEED_FAN_OUT_LIMIT)
+notification_store = notifications.NotificationStore(
+    store.collection("notifications"), store.collection("unread_counts"), NOTIFY_INBOX_LIMIT, NOTIFY_RETENTION_DAYS
+)
 
 # ------------------------------
 # Helper functions
 # ------------------------------
 def load_users():
-    if not os.path.exists(USER_FILE):
-        return {}
-    with open(USER_FILE, "r") as f:
-        return json.load(f)
+    # read-only snapshot shared between requests, use load_user() to edit
+    return store.users.snapshot().docs
 
 def save_users(users):
-    with open(USER_FILE, "w") as f:
-        json.dump(users, f, indent=2)
+    store.users.replace(users)
+    user_index.rebuild(users)
+
+def load_user(username):
+    return store.users.get(username)
+
+def save_user(username, data):
+    store.users.put(username, data)
+    if isinstance(data, dict):
+        user_index.add(username, data.get("hint"))
+
+def remove_user(username):
+    store.users.delete(username)
+    user_index.remove(username)
+
+def user_videos_page(username, after=None, limit=PAGE_SIZE):
+    # one page of username's videos newest first, plus the next page's cursor
+    rows, next_after = store.videos.find_page(where={"uploader": username}, order_by=("uploaded_at",), desc=True,
+                                              after=after, limit=limit)
+    return [doc for _, doc in rows], next_after
+
+def user_video_ids(username):
+    return [key for key, _ in store.videos.find(where={"uploader": username})]
 
 def time_since(uploaded):
     from datetime import datetime, timezone
@@ -65,61 +197,43 @@ def time_since(uploaded):
     else:
         return uploaded.strftime("%b %d, %Y")
 
-def ensure_user_fields(users):
-    changed = False
-    for u, data in list(users.items()):
-        if isinstance(data, str):
-            users[u] = {
-                "password": data,
-                "bio": "",
-                "profile_pic": "",
-                "followers": [],
-                "following": [],
-                "notifications": [],
-                "shadowbanned": False
-            }
-            changed = True
-        else:
-            if "followers" not in data:
-                data["followers"] = []
-                changed = True
-            if "following" not in data:
-                data["following"] = []
-                changed = True
-            if "notifications" not in data:
-                data["notifications"] = []
-                changed = True
-            if "shadowbanned" not in data:
-                data["shadowbanned"] = False
-                changed = True
-    if changed:
-        save_users(users)
+def new_user(password_hash, hint=""):
+    # every user record starts out like this, migrate_user_fields() brings
+    # older ones up to the same shape
+    return {
+        "password": password_hash,
+        "bio": "",
+        "profile_pic": None,
+        "hint": hint,
+        "shadowbanned": False
+    }
+
+role_registry = roles.RoleRegistry(store.roles)
 
 def load_admins():
-    if not os.path.exists(ADMIN_FILE):
-        # create a default file with an empty lists
-        default = {"admins": [], "moderators": []}
-        with open(ADMIN_FILE, "w") as f:
-            json.dump(default, f, indent=2)
-        return default
-    with open(ADMIN_FILE, "r") as f:
-        return json.load(f)
+    return {list_name: role_registry.members(role) for role, list_name in storage.ROLE_LISTS.items()}
 
 def save_admins(admins_obj):
-    with open(ADMIN_FILE, "w") as f:
-        json.dump(admins_obj, f, indent=2)
+    roles = {}
+    for role, list_name in storage.ROLE_LISTS.items():
+        for username in admins_obj.get(list_name, []):
+            roles[f"{role}:{username}"] = {"role": role, "username": username}
+    store.roles.replace(roles)
+
+def user_roles(username):
+    # looked up once per user per request, templates and decorators ask a lot
+    if not has_request_context():
+        return role_registry.roles_of(username)
+    cache = g.setdefault("user_roles", {})
+    if username not in cache:
+        cache[username] = role_registry.roles_of(username)
+    return cache[username]
 
 def is_admin(username):
-    if not username:
-        return False
-    admins_obj = load_admins()
-    return username in admins_obj.get("admins", [])
+    return "admin" in user_roles(username)
 
 def is_moderator(username):
-    if not username:
-        return False
-    admins_obj = load_admins()
-    return username in admins_obj.get("moderators", [])
+    return "moderator" in user_roles(username)
 
 # ------------------------------
 # In-memory video storage
@@ -129,51 +243,512 @@ videos = []
 # ------------------------------
 # Routes
 # ------------------------------
-VIDEO_FILE = "videos.json"
-
 def load_videos():
-    if not os.path.exists(VIDEO_FILE):
-        return []
-    with open(VIDEO_FILE, "r") as f: 
-        return json.load(f)
+    # read-only snapshot shared between requests, use load_video() to edit
+    return store.videos.values()
 
 def save_videos(videos):
-    with open(VIDEO_FILE, "w") as f:
-        json.dump(videos, f, indent=2, ensure_ascii=False)
+    store.videos.replace({v["id"]: v for v in videos})
+
+def load_video(video_id):
+    return store.videos.get(video_id)
+
+def save_video(video):
+    store.videos.put(video["id"], video)
+
+def remove_video(video_id):
+    video = store.videos.get(video_id)
+    store.videos.delete(video_id)
+    search_index.remove_video(video_id)
+    vote_store.remove_scope(video_id)
+    comment_store.remove_video(video_id)
+    timelines.remove_video(video_id)
+    if video:
+        newest = store.videos.find(where={"uploader": video["uploader"]}, order_by=("uploaded_at",), desc=True, limit=1)
+        creator_board.video_removed(video["uploader"], video.get("likes", 0),
+                                    newest[0][1]["uploaded_at"] if newest else None)
+
+def index_video(video):
+    # keep the search index in sync after a video is added or edited
+    uploader = load_user(video.get("uploader")) or {}
+    search_index.index_video(video, hidden=uploader.get("shadowbanned", False))
+
+def rebuild_search_index():
+    users = load_users()
+    search_index.rebuild(load_videos(), lambda v: users.get(v.get("uploader"), {}).get("shadowbanned", False))
+    store.set_meta("search_index", datetime.utcnow().isoformat())
+
+def atomic(f):
+    # runs the handler in one store transaction, so its load -> change -> save
+    # can't interleave with another worker's. Only for short POST handlers:
+    # anything slow (password hashing, file I/O) or a GET render would hold
+    # the store's write lock the whole time, open a transaction around just
+    # the load -> save instead.
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with store.transaction():
+            return f(*args, **kwargs)
+    return wrapper
+
+# ------------------------------
+# Schema migrations
+# ------------------------------
+# Each migration brings every stored record up to one schema version, the
+# store remembers the last one applied in its "schema_version" meta. They run
+# once at startup (or with `flask migrate`), so request handlers can count on
+# the current shape and never scan or fix up records themselves.
+
+def migrate_user_fields():
+    # password-only string records and records missing newer fields
+    with store.transaction():
+        for username, user in store.users.items():
+            if isinstance(user, str):
+                save_user(username, new_user(user))
+            elif any(field not in user for field in new_user("")):
+                save_user(username, dict(new_user(""), **storage.thaw(user)))
+
+def migrate_votes():
+    # older records kept liked_by/disliked_by lists, move them into the vote
+    # store and keep just the counts
+    def move(doc, target, video_id):
+        if "liked_by" in doc or "disliked_by" in doc:
+            liked_by, disliked_by = doc.pop("liked_by", []), doc.pop("disliked_by", [])
+            vote_store.import_lists(target, video_id, liked_by, disliked_by)
+            doc["likes"], doc["dislikes"] = len(liked_by), len(disliked_by)
+            return True
+        return False
+
+    def move_comments(comments, video_id):
+        changed = False
+        for c in comments:
+            changed |= move(c, votes.comment_target(c["id"]), video_id)
+            changed |= move_comments(c.get("replies", []), video_id)
+        return changed
+
+    with store.transaction():
+        for video_id, video in store.videos.items():
+            video = storage.thaw(video)
+            changed = move(video, votes.video_target(video_id), video_id)
+            if move_comments(video.get("comments", []), video_id) or changed:
+                save_video(video)
+
+def migrate_comments():
+    # older records kept the comments nested in the video, move them into
+    # the comment store (after migrate_votes(), which reads them there)
+    with store.transaction():
+        for video_id, video in store.videos.items():
+            if "comments" in video:
+                video = storage.thaw(video)
+                comment_store.import_tree(video_id, video.pop("comments"))
+                save_video(video)
+
+def migrate_notifications():
+    # older user records kept their notifications in a list
+    with store.transaction():
+        for username, user in store.users.items():
+            if isinstance(user, dict) and "notifications" in user:
+                user = storage.thaw(user)
+                notification_store.import_inbox(username, user.pop("notifications"))
+                save_user(username, user)
+
+def migrate_follows():
+    # older user records kept followers/following lists, move them into the
+    # follow graph
+    with store.transaction():
+        users = {u: user for u, user in store.users.items() if "followers" in user or "following" in user}
+        follow_graph.import_lists(users)
+        for username, user in users.items():
+            user = storage.thaw(user)
+            user.pop("followers", None)
+            user.pop("following", None)
+            save_user(username, user)
+
+def repair_notification_counts():
+    return notification_store.repair()
+
+def rebuild_user_index():
+    user_index.rebuild(load_users())
+
+def rebuild_timelines():
+    timelines.rebuild(follow_graph.pairs(), lambda u: follow_graph.count(u)[0], FEED_BACKFILL)
+
+def rebuild_leaderboard():
+    users = load_users()
+    creator_board.rebuild(load_videos(), lambda u: users.get(u, {}).get("shadowbanned", False))
+
+# (version, migration), in the order they have to run
+SCHEMA_MIGRATIONS = [
+    (1, migrate_user_fields),
+    (2, migrate_votes),
+    (3, migrate_comments),
+    (4, migrate_notifications),
+    (5, repair_notification_counts),
+    (6, rebuild_leaderboard),
+    (7, rebuild_user_index),
+    (8, migrate_follows),
+    (9, rebuild_timelines),
+]
+
+def migrate_schema():
+    # runs whatever this store hasn't had yet, returns the names of those
+    applied = []
+    for version, migration in SCHEMA_MIGRATIONS:
+        with store.transaction():
+            # checked inside the transaction, another worker may be starting too
+            if version <= int(store.get_meta("schema_version") or 0):
+                continue
+            migration()
+            store.set_meta("schema_version", str(version))
+        applied.append(migration.__name__)
+    return applied
+
+migrate_schema()
+
+if not store.get_meta("search_index"):
+    rebuild_search_index()
+
+# ------------------------------
+# Upload processing
+# ------------------------------
+# upload() only stores the raw file and a "processing" video record, the
+# crop/encode and thumbnail run on the transcode queue. Jobs live in the
+# store, so uploads that were half done when the server stopped pick up again
+# on the next start.
+#
+# Uploads are keyed by the hash of their bytes in the "media" collection.
+# Identical uploads share one entry (one transcode, thumbnail and HLS ladder),
+# the entry lists the videos using it and its files go with the last of them.
+# Uploaded thumbnails get entries of their own the same way.
+
+media_files = store.collection("media")
+
+def publish_file(folder, path, digest=None):
+    # the finished file under its content hash, returns the new name
+    name = (digest or media.content_hash(path)) + os.path.splitext(path)[1].lower()
+    target = os.path.join(folder, name)
+    if not os.path.exists(target):
+        try:
+            os.link(path, target)
+        except OSError:
+            shutil.copyfile(path, target)
+    else:
+        os.utime(target)  # fresh again, the reconciler leaves recent files alone
+    return name
+
+def remove_media_files(files):
+    # published names are content hashes, so different uploads can end up
+    # with the same file (identical first-frame thumbnails are common). A name
+    # another media entry still points at stays, call this once the entry the
+    # files came from is gone from the store.
+    in_use = {(kind, entry.get(kind)) for entry in media_files.values() for kind in ("video", "thumbnail")}
+    for kind, folder in (("video", VIDEO_FOLDER), ("thumbnail", THUMB_FOLDER)):
+        name = files.get(kind)
+        if name and (kind, name) not in in_use:
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                os.remove(path)
+    if files.get("hls"):
+        shutil.rmtree(os.path.join(HLS_FOLDER, os.path.dirname(files["hls"])), ignore_errors=True)
+
+def acquire_media(media_hash, video_id, **new_entry):
+    # adds video_id to the entry's users, creating it from new_entry if needed
+    entry = media_files.get(media_hash)
+    if entry is None:
+        entry = dict({"hash": media_hash, "status": "ready", "videos": [], "video": None,
+                      "thumbnail": None, "hls": None, "renditions": []}, **new_entry)
+    if video_id not in entry["videos"]:
+        entry["videos"].append(video_id)
+    media_files.put(media_hash, entry)
+    return entry
+
+def release_media(media_hash, video_id):
+    entry = media_files.get(media_hash)
+    if not entry:
+        return
+    if video_id in entry["videos"]:
+        entry["videos"].remove(video_id)
+    if entry["videos"] or entry["status"] == "processing":
+        # still in use, or its job is running and will clean up
+        media_files.put(media_hash, entry)
+    else:
+        media_files.delete(media_hash)
+        remove_media_files(entry)
+
+def delete_video_files(video):
+    # shared files stay until the last video using them is deleted
+    if "media" in video:
+        for media_hash in video["media"]:
+            release_media(media_hash, video["id"])
+    else:  # uploaded before the media store, nothing shared
+        remove_media_files(video)
+
+def package_renditions(media_hash, mp4_path):
+    # adds the source rendition (the mp4, stream copied) to the ladder the
+    # encode left in the upload's HLS folder and writes the master playlist
+    hls_dir = os.path.join(HLS_FOLDER, media_hash)
+    media.package_hls(mp4_path, os.path.join(hls_dir, "source"))
+    source = probe.probe_video(mp4_path)
+    renditions = []
+    for name in sorted(os.listdir(hls_dir)):
+        rendition_dir = os.path.join(hls_dir, name)
+        if not os.path.exists(os.path.join(rendition_dir, media.HLS_PLAYLIST)):
+            continue
+        width, height = (source["width"], source["height"]) if name == "source" else (int(name[:-1]),) * 2
+        renditions.append({
+            "name": name,
+            "width": width,
+            "height": height,
+            "bandwidth": media.peak_bandwidth(rendition_dir),
+            "playlist": f"{name}/{media.HLS_PLAYLIST}"
+        })
+    media.write_master_playlist(os.path.join(hls_dir, "master.m3u8"), renditions)
+    return renditions
+
+def notify_followers(video):
+    # fanned out by the notify queue, however many followers there are
+    event_id = str(uuid.uuid4())
+    notify_queue.submit({"event": {
+        "id": event_id,
+        "type": "upload",
+        "from_user": video["uploader"],
+        "video_id": video["id"],
+        "video_title": video["title"]
+    }}, job_id=event_id)
+
+def publish_video(video, entry):
+    # points a video at its finished upload, an uploaded thumbnail wins
+    video.update(status="ready", video=entry["video"], hls=entry["hls"], renditions=entry["renditions"])
+    if not video.get("thumbnail"):
+        video["thumbnail"] = entry["thumbnail"]
+    video.pop("error", None)
+    save_video(video)
+    notify_followers(video)
+
+def process_upload(job, progress):
+    payload = job["payload"]
+    media_hash = payload["media"]
+    temp_path = payload["temp_path"]
+    final_path = os.path.join(VIDEO_FOLDER, f"{media_hash}.work.mp4")
+    # the upload itself, under its own extension, if every encode attempt fails
+    raw_path = os.path.join(VIDEO_FOLDER, f"{media_hash}.work{os.path.splitext(temp_path)[1].lower()}")
+    thumb_path = os.path.join(THUMB_FOLDER, f"{media_hash}.work.png")
+    hls_dir = os.path.join(HLS_FOLDER, media_hash)
+
+    entry = media_files.get(media_hash)
+    if not entry or not entry["videos"]:
+        # every video using it was deleted before we got to it
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        if entry:
+            media_files.delete(media_hash)
+        return
+
+    if os.path.exists(temp_path):
+        progress("transcoding")
+        info = payload.get("probe") or {}
+        preset = X264_PRESET if job["attempt"] == 1 else RETRY_PRESET
+        # the thumbnail and smaller renditions come out of the same decode as the mp4
+        source_size = min(info["width"], info["height"]) if info.get("width") and info.get("height") else None
+        ladder = [
+            lambda v, a, size=size, kbps=kbps: media.hls_output(v, a, os.path.join(hls_dir, f"{size}p"), size, kbps, preset)
+            for size, kbps in HLS_LADDER if not source_size or size < source_size
+        ]
+        shutil.rmtree(hls_dir, ignore_errors=True)
+        os.makedirs(hls_dir)
+        try:
+            seconds = media.transcode(
+                temp_path, final_path, thumb_path, extra_outputs=ladder,
+                has_audio=info.get("audio_codec") is not None if info else True,
+                duration=info.get("duration"),
+                preset=preset,
+                crf=X264_CRF,
+                timeout=ENCODE_TIME_BUDGET
+            )
+            print(f"Encoded {media_hash} in {seconds:.2f}s")
+            os.remove(temp_path)
+        except Exception as e:
+            shutil.rmtree(hls_dir, ignore_errors=True)
+            if job["attempt"] < job["max_attempts"]:
+                raise
+            print("FFmpeg processing failed:", e)
+            if os.path.exists(final_path) and final_path != raw_path:
+                os.remove(final_path)  # whatever the failed encode left
+            os.replace(temp_path, raw_path)  # fallback to raw upload
+            final_path = raw_path
+    elif not os.path.exists(final_path):
+        if not os.path.exists(raw_path):
+            raise FileNotFoundError(f"upload {temp_path} is gone")
+        final_path = raw_path  # the raw fallback, from before a restart
+
+    if not os.path.exists(thumb_path):
+        # raw fallback, or the encode finished before a restart
+        progress("thumbnail")
+        try:
+            media.make_thumbnail(final_path, thumb_path)
+        except Exception as e:
+            print("Thumbnail generation failed:", e)
+
+    # HLS only for encoded uploads, a raw fallback is served as it is
+    hls, renditions = None, []
+    if os.path.isdir(hls_dir):
+        progress("packaging")
+        try:
+            renditions = package_renditions(media_hash, final_path)
+            hls = f"{media_hash}/master.m3u8"
+        except Exception as e:
+            print("HLS packaging failed:", e)
+            shutil.rmtree(hls_dir, ignore_errors=True)
+
+    # Published under content hashes, the working files go once the records
+    # point at them (until then a restarted job still finds them)
+    progress("publishing")
+    files = {
+        "video": publish_file(VIDEO_FOLDER, final_path),
+        "thumbnail": publish_file(THUMB_FOLDER, thumb_path) if os.path.exists(thumb_path) else None,
+        "hls": hls,
+    }
+    with store.transaction():
+        entry = media_files.get(media_hash)
+        if entry and entry["videos"]:
+            entry.update(files, status="ready", renditions=renditions, error=None)
+            media_files.put(media_hash, entry)
+            for video_id in entry["videos"]:
+                video = load_video(video_id)
+                if video:
+                    publish_video(video, entry)
+        else:
+            # deleted while it was processing
+            if entry:
+                media_files.delete(media_hash)
+            remove_media_files(files)
+    for path in (final_path, thumb_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+def upload_failed(job, error):
+    payload = job["payload"]
+    if os.path.exists(payload["temp_path"]):
+        os.remove(payload["temp_path"])
+    with store.transaction():
+        entry = media_files.get(payload["media"])
+        if not entry:
+            return
+        entry.update(status="failed", error=error)
+        media_files.put(payload["media"], entry)
+        for video_id in entry["videos"]:
+            video = load_video(video_id)
+            if video:
+                video.update(status="failed", error=error)
+                save_video(video)
+
+transcode_queue = jobs.JobQueue(
+    store.collection("jobs"), process_upload, on_failed=upload_failed,
+    workers=TRANSCODE_WORKERS, slots=TRANSCODE_SLOTS, max_attempts=TRANSCODE_ATTEMPTS
+)
+
+# ------------------------------
+# Upload fan-out
+# ------------------------------
+# An upload notifies the uploader's followers NOTIFY_BATCH_SIZE at a time,
+# one transaction per batch, and goes into their following feeds in the same
+# batches (unless the uploader is large, see feeds.py). A retried job sends
+# the same event again, and followers who already have it are skipped.
+
+def fan_out_upload(job, progress):
+    event = job["payload"]["event"]
+    total = follow_graph.count(event["from_user"])[0]
+    video = load_video(event["video_id"])
+    if video and timelines.check_large(event["from_user"], total):
+        video = None
+    sent = 0
+    for batch in follow_graph.iter_followers(event["from_user"], NOTIFY_BATCH_SIZE):
+        with store.transaction():
+            notification_store.add_many(batch, event)
+            if video:
+                timelines.add_many(batch, video)
+        sent += len(batch)
+        progress(f"sent {sent}/{total}")
+    notification_store.prune()
+
+notify_queue = jobs.JobQueue(store.collection("notify_jobs"), fan_out_upload, workers=NOTIFY_WORKERS)
+
+# ------------------------------
+# Listing pages
+# ------------------------------
+# Pages are fetched straight from the sorted indexes with keyset cursors
+# (?after=...), so a page costs the same no matter how deep it is.
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor, arity=2):
+    # the values encode_cursor() packed, or None unless they're arity plain
+    # strings and numbers (anyone can put anything in ?after=)
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != arity:
+        return None
+    if not all(isinstance(v, (str, int, float)) and not isinstance(v, bool) for v in values):
+        return None
+    return values
+
+def list_videos(sort_by, after=None, limit=PAGE_SIZE):
+    # one page of videos plus the cursor of the next page (None on the last)
+    column = SORT_COLUMNS.get(sort_by, "uploaded_at")
+    rows, next_after = store.videos.find_page(order_by=(column,), desc=True, after=after, limit=limit)
+    return [doc for _, doc in rows], next_after
+
+def following_feed(username, after=None, limit=PAGE_SIZE):
+    # username's following feed, from their timeline plus whichever large
+    # creators they follow
+    pulled = follow_graph.following_among(username, timelines.large_creators())
+    ids, next_after = timelines.page(username, pulled, after, limit)
+    return [v for v in (load_video(i) for i in ids) if v], next_after
 
 @app.route("/videos")
 def get_videos():
-    videos = load_videos()
-    return jsonify({"videos": videos})
+    sort_by = request.args.get("sort", "newest")
+    limit = max(1, min(request.args.get("limit", PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    videos, next_after = list_videos(sort_by, decode_cursor(request.args.get("after")), limit)
+    return jsonify({"videos": videos, "next": encode_cursor(next_after) if next_after else None})
+
+def hls_js_source():
+    # {"src", "integrity"} for the player's hls.js, None if there's none to load
+    if HLS_JS_URL and HLS_JS_INTEGRITY:
+        return {"src": HLS_JS_URL, "integrity": HLS_JS_INTEGRITY}
+    if os.path.exists(HLS_JS_FILE):
+        return {"src": url_for("static", filename="vendor/hls.min.js"), "integrity": None}
+    return None
 
 @app.route("/video/<video_id>")
 def video_page(video_id):
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = load_video(video_id)
     if not video:
         return "Video not found", 404
 
-    # Increment view count
-    video["views"] = video.get("views", 0) + 1
-    save_videos(videos)
+    # Count the view, it gets written to the store with the next batch
+    view_counter.hit(video_id)
+    video["views"] = view_counter.views(video)
 
     description = video.get("description")
     
     username = session.get("username")
     logged_in = "username" in session
-    user_liked = username in video.get("liked_by", []) if username else False
-    user_disliked = username in video.get("disliked_by", []) if username else False
+    user_vote = vote_store.get(votes.video_target(video_id), username)
+    user_liked = user_vote == votes.LIKE
+    user_disliked = user_vote == votes.DISLIKE
 
     uploaded_ago = time_since(video["uploaded_at"])
 
-    def mark_comment_votes(comments):
-        for c in comments:
-            c["current_user_liked"] = username in c.get("liked_by", []) if username else False
-            c["current_user_disliked"] = username in c.get("disliked_by", []) if username else False
-            if c.get("replies"):
-                mark_comment_votes(c["replies"])
-
-    mark_comment_votes(video.get("comments", []))
+    # only the first page of top level comments, replies and further pages
+    # are fetched from /video/<id>/comments as they're opened
+    first_comments, next_after = comment_store.page(video_id, None, None, COMMENTS_PAGE_SIZE)
+    # the viewer's comment votes on this video, one indexed lookup
+    liked_comments, disliked_comments = vote_store.overlay(username, video_id)
 
     return render_template(
         "video.html",
@@ -183,60 +758,72 @@ def video_page(video_id):
         username=username,
         user_liked=user_liked,
         user_disliked=user_disliked,
-        uploaded_ago=uploaded_ago
+        uploaded_ago=uploaded_ago,
+        hls_js=hls_js_source() if video.get("hls") else None,
+        comments=first_comments,
+        comments_next=encode_cursor(next_after) if next_after else None,
+        liked_comments=liked_comments,
+        disliked_comments=disliked_comments
     )
 
+@app.route("/video/<video_id>/comments")
+def video_comments(video_id):
+    # ?parent=<comment id> for replies, top level comments otherwise
+    if not load_video(video_id):
+        return jsonify({"error": "Video not found"}), 404
+    after = decode_cursor(request.args.get("after"))
+    limit = max(1, min(request.args.get("limit", COMMENTS_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    page, next_after = comment_store.page(video_id, request.args.get("parent") or None, after, limit)
+    # which of these the viewer voted on, sent alongside the comments
+    liked, disliked = vote_store.overlay(session.get("username"), video_id)
+    ids = {c["id"] for c in page}
+    return jsonify({
+        "comments": page,
+        "next": encode_cursor(next_after) if next_after else None,
+        "liked": sorted(liked & ids),
+        "disliked": sorted(disliked & ids)
+    })
+
 @app.route("/")
 def index():
-    sort_by = request.args.get("sort", "newest")
     search_query = request.args.get("q", "").lower().strip()
     username = session.get("username")
     logged_in = "username" in session
-    videos = load_videos()
-    users = load_users()
-    ensure_user_fields(users)
-
-    def visible_in_search(video, viewer):
-        uploader = video.get("uploader")
-        if not uploader:
-            return False
-        
-        uploader_data = users.get(uploader, {})
-        if uploader_data.get("shadowbanned", False):
-            return False
-        
-        # Admin bypass (optional — remove if you want admins to filter too)
-        if is_admin(viewer):
-            pass  # allow search normally
-        
-        # Check title, description, and uploader for the query
-        query = search_query.lower().strip()
-        title = video.get("title", "").lower()
-        description = video.get("description", "").lower()
-        uploader_lower = uploader.lower()
-        
-        return query in title or query in description or query in uploader_lower
-
-    # Filter videos by search query if present
+    # search results come best match first unless another order is picked,
+    # logged in users who follow someone start on their following feed
     if search_query:
-        videos = [v for v in videos if visible_in_search(v, session.get("username"))]
+        default_sort = "relevance"
+    elif username and follow_graph.count(username)[1]:
+        default_sort = "following"
+    else:
+        default_sort = "newest"
+    sort_by = request.args.get("sort", default_sort)
 
-    # Convert uploaded_at to datetime for proper sorting
-    for v in videos:
-        try:
-            v["_uploaded_dt"] = datetime.fromisoformat(v["uploaded_at"])
-        except Exception:
-            v["_uploaded_dt"] = datetime.min  # fallback if invalid
+    if search_query:
+        # Search the index (shadowbanned uploaders aren't in it). Results are
+        # capped at SEARCH_LIMIT, so they're paged by position.
+        matches = search_index.search(search_query, SEARCH_LIMIT)
+        after = decode_cursor(request.args.get("after"), 1)
+        start = after[0] if after and isinstance(after[0], int) and after[0] >= 0 else 0
+        if sort_by in SORT_COLUMNS:
+            column = SORT_COLUMNS[sort_by]
+            found = [v for v in (load_video(i) for i in matches) if v]
+            found.sort(key=lambda v: v.get(column, 0), reverse=True)
+            videos = found[start:start + PAGE_SIZE]
+        else:  # relevance, the order the index returned
+            videos = [v for v in (load_video(i) for i in matches[start:start + PAGE_SIZE]) if v]
+        next_after = [start + PAGE_SIZE] if len(matches) > start + PAGE_SIZE else None
+    elif sort_by == "following" and username:
+        videos, next_after = following_feed(username, decode_cursor(request.args.get("after")))
+    else:
+        videos, next_after = list_videos(sort_by, decode_cursor(request.args.get("after")))
 
+    # Only the videos on this page get their labels worked out
+    # (cached videos are read-only, so work on shallow copies)
+    videos = [dict(v) for v in videos]
+    for v in videos:
         v["uploaded_ago"] = time_since(v["uploaded_at"])
-
-    # Sort videos
-    if sort_by == "views":
-        videos = sorted(videos, key=lambda v: v.get("views", 0), reverse=True)
-    elif sort_by == "likes":
-        videos = sorted(videos, key=lambda v: v.get("likes", 0), reverse=True)
-    else:  # newest
-        videos = sorted(videos, key=lambda v: v["_uploaded_dt"], reverse=True)
+        v["views"] = view_counter.views(v)
 
     return render_template(
         "index.html",
@@ -245,7 +832,8 @@ def index():
         videos=videos,
         time_since=time_since,
         current_sort=sort_by,
-        search_query=search_query
+        search_query=search_query,
+        next_cursor=encode_cursor(next_after) if next_after else None
     )
 
 @app.route("/signup", methods=["GET", "POST"])
@@ -255,18 +843,15 @@ def signup():
         password = request.form["password"].strip()
         recovery_code = request.form.get("recovery_code")
 
-        users = load_users()
-        if username in users:
+        if load_user(username):
             return "That username already exists."
 
+        # hashing is slow, done before the transaction
         hashed = generate_password_hash(password)
-        users[username] = {
-            "password": hashed,
-            "bio": "",
-            "profile_pic": None,
-            "hint": request.form.get("hint", "")
-        }
-        save_users(users)
+        with store.transaction():
+            if load_user(username):
+                return "That username already exists."
+            save_user(username, new_user(hashed, request.form.get("hint", "")))
 
         session["username"] = username
         return redirect("/")
@@ -279,17 +864,10 @@ def login():
         username = request.form["username"].strip()
         password = request.form["password"].strip()
 
-        users = load_users()
-        stored = users.get(username)
+        stored = load_user(username)
         if not stored:
             return "User not found."
 
-        # If it's an old user (string type), convert to dict automatically
-        if isinstance(stored, str):
-            stored = {"password": stored, "bio": "", "profile_pic": None}
-            users[username] = stored
-            save_users(users)
-
         if check_password_hash(stored["password"], password):
             session["username"] = username
             return redirect("/")
@@ -311,7 +889,78 @@ def upload_page():
 
 import uuid
 
-from moviepy.editor import VideoFileClip
+def check_upload(info):
+    # why an upload can't be accepted, from its probed metadata (None if it's fine)
+    if not info["video_codec"]:
+        return "That file has no video track."
+    if info["duration"] is None:
+        return "Couldn't read the length of that video."
+    if info["duration"] > MAX_VIDEO_SECONDS:
+        return "Video is too long! Maximum length is 1 second."
+    if max(info["width"] or 0, info["height"] or 0) > MAX_VIDEO_DIMENSION:
+        return f"Video is too large! Maximum size is {MAX_VIDEO_DIMENSION}px on a side."
+    return None
+
+def create_video(video_id, part_path, media_hash, ext, info, title, description, thumbnail_file=None):
+    # the video record for a fully received, checked upload at part_path,
+    # shared by /upload and the chunked uploads
+    thumb_path = thumb_hash = None
+    if thumbnail_file:
+        thumb_ext = os.path.splitext(secure_filename(thumbnail_file.filename))[1]
+        thumb_path = os.path.join(UPLOAD_TEMP_FOLDER, f"{video_id}_thumb{thumb_ext}")
+        thumb_hash = media.save_hashed(thumbnail_file.stream, thumb_path)
+
+    video = {
+        "id": video_id,
+        "title": title,
+        "description": description,
+        "video": None,
+        "thumbnail": None,
+        "media": [media_hash],
+        "status": "processing",
+        "job_id": media_hash,
+        "uploader": session["username"],
+        "views": 0,
+        "likes": 0,
+        "dislikes": 0,
+        "uploaded_at": datetime.utcnow().isoformat(),
+    }
+    with store.transaction():
+        entry = media_files.get(media_hash)
+        if entry is None or entry["status"] == "failed":
+            # new upload, transcode it
+            temp_path = os.path.join(UPLOAD_TEMP_FOLDER, media_hash + ext)
+            os.replace(part_path, temp_path)
+            if entry is not None:
+                # an earlier transcode of these bytes failed, this upload retries
+                # it and any further upload of them joins in until it's done
+                entry.update(status="processing", error=None)
+                media_files.put(media_hash, entry)
+            entry = acquire_media(media_hash, video_id, status="processing")
+            transcode_queue.submit({"media": media_hash, "temp_path": temp_path, "probe": info}, job_id=media_hash)
+        else:
+            # seen these exact bytes before, reuse that transcode (or join the
+            # one still processing)
+            os.remove(part_path)
+            entry = acquire_media(media_hash, video_id)
+
+        # Thumbnail: an uploaded one gets stored now, otherwise the upload's own is used
+        if thumb_path:
+            thumb_entry = media_files.get(thumb_hash)
+            thumbnail = thumb_entry["thumbnail"] if thumb_entry else publish_file(THUMB_FOLDER, thumb_path, thumb_hash)
+            acquire_media(thumb_hash, video_id, thumbnail=thumbnail)
+            os.remove(thumb_path)
+            video["media"].append(thumb_hash)
+            video["thumbnail"] = thumbnail
+
+        # Save video metadata, it's shown as processing until the job publishes it
+        index_video(video)
+        creator_board.video_added(video["uploader"], video["uploaded_at"],
+                                  hidden=(load_user(video["uploader"]) or {}).get("shadowbanned", False))
+        if entry["status"] == "ready":
+            publish_video(video, entry)
+        else:
+            save_video(video)
 
 @app.route("/upload", methods=["POST"])
 def upload():
@@ -327,132 +976,263 @@ def upload():
     if not title or not video_file:
         return "Title and video file are required.", 400
 
-    os.makedirs("temp", exist_ok=True)
+    os.makedirs(UPLOAD_TEMP_FOLDER, exist_ok=True)
     os.makedirs(VIDEO_FOLDER, exist_ok=True)
     os.makedirs(THUMB_FOLDER, exist_ok=True)
 
-    # Save temporary upload
-    temp_filename = f"{datetime.utcnow().strftime('%Y-%m-%d_%H-%M-%S')}_{secure_filename(video_file.filename)}"
-    temp_path = os.path.join("temp", temp_filename)
-    video_file.save(temp_path)
+    # Save the upload, hashing it on the way to disk
+    ext = os.path.splitext(secure_filename(video_file.filename))[1].lower()
+    part_path = os.path.join(UPLOAD_TEMP_FOLDER, f"{video_id}.part")
+    media_hash = media.save_hashed(video_file.stream, part_path)
 
-    # Check duration
-    clip = VideoFileClip(temp_path)
-    if clip.duration > 1.0:
-        clip.close()
-        os.remove(temp_path)
-        return "Video is too long! Maximum length is 1 second.", 400
-    clip.close()
+    # Check length and size from the container headers, before any decoding
+    try:
+        info = probe.probe_video(part_path)
+        error = check_upload(info)
+    except probe.ProbeError as e:
+        info, error = None, f"Couldn't read that video: {e}."
+    if error:
+        os.remove(part_path)
+        return error, 400
 
-    final_filename = temp_filename
-    final_path = os.path.join(VIDEO_FOLDER, final_filename)
-    square_path = final_path.replace(".mp4", "_square.mp4")
+    create_video(video_id, part_path, media_hash, ext, info, title, description, thumbnail_file)
+    return redirect(url_for("video_page", video_id=video_id))
 
-    try:
-        # Crop to square and preserve audio (or add silent audio if missing)
-        input_stream = ffmpeg.input(temp_path)
-        video_stream = input_stream.video.filter(
-            'crop', 'min(iw,ih)', 'min(iw,ih)', '(ow-iw)/-2', '(oh-ih)/-2'
-        )
-        audio_stream = input_stream.audio if input_stream.audio else ffmpeg.input('anullsrc=cl=stereo:r=44100').audio
+# ------------------------------
+# Chunked uploads
+# ------------------------------
+# Resumable uploads for big files and flaky connections:
+#   POST   /uploads                     {filename, size} -> {upload_id, offset, chunk_size}
+#   PUT    /uploads/<id>                raw bytes, Upload-Offset header = bytes already sent
+#   GET    /uploads/<id>                where to resume from
+#   POST   /uploads/<id>/finalize       title, description, thumbnail -> the new video
+#   DELETE /uploads/<id>                give up
+# Chunks are appended to temp/<id>.part, the file size is the resume offset.
+# MP4/MOV headers are probed as soon as they've arrived, so a clip that's too
+# long is turned away without waiting for the rest of it.
+
+upload_sessions = store.collection("uploads")
+
+def upload_part_path(upload_id):
+    return os.path.join(UPLOAD_TEMP_FOLDER, f"{upload_id}.part")
+
+def load_upload_session(upload_id):
+    # (session record, error response) for the logged in user's upload
+    if "username" not in session:
+        return None, (jsonify({"error": "You must be logged in to upload."}), 403)
+    upload_session = upload_sessions.get(upload_id)
+    if not upload_session or upload_session["owner"] != session["username"]:
+        return None, (jsonify({"error": "Upload not found"}), 404)
+    return upload_session, None
+
+def discard_upload(upload_id):
+    upload_sessions.delete(upload_id)
+    for path in (upload_part_path(upload_id), upload_part_path(upload_id) + ".lock"):
+        if os.path.exists(path):
+            os.remove(path)
+
+# ------------------------------
+# Storage clean up
+# ------------------------------
+reconciler = reconcile.Reconciler(
+    store, media_files, upload_sessions, transcode_queue.jobs, MEDIA_FOLDERS, UPLOAD_TEMP_FOLDER,
+    upload_ttl=UPLOAD_SESSION_TTL
+)
 
-        # Combine video and audio in one command
-        ffmpeg.output(
-            video_stream, audio_stream, square_path,
-            vcodec='libx264', acodec='aac', audio_bitrate='128k',
-            strict='experimental'
-        ).overwrite_output().run(quiet=True)
+# ------------------------------
+# Background work
+# ------------------------------
+# The view counter flush, job queues, reconciler and leaderboard rescoring
+# start with the first request a process serves. CLI commands (`flask
+# migrate`, `reconcile-storage`...) never serve one, so they never claim
+# uploads they'd then abandon when they exit.
+
+background_lock = threading.Lock()
+background_started = False
+
+@app.before_request
+def start_background_work():
+    global background_started
+    if background_started:
+        return
+    with background_lock:
+        if not background_started:
+            view_counter.start()
+            transcode_queue.start()
+            notify_queue.start()
+            reconciler.start(RECONCILE_INTERVAL)
+            creator_board.start(LEADERBOARD_RESCORE_INTERVAL)
+            background_started = True
+
+@app.route("/uploads", methods=["POST"])
+def start_upload():
+    if "username" not in session:
+        return jsonify({"error": "You must be logged in to upload."}), 403
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(data.get("filename") or "")
+    try:
+        size = int(data.get("size"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "filename and size are required."}), 400
+    if not filename or size <= 0:
+        return jsonify({"error": "filename and size are required."}), 400
+    if size > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"Video is too big! Maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB."}), 413
+
+    upload_id = str(uuid.uuid4())
+    now = datetime.utcnow().isoformat()
+    upload_sessions.put(upload_id, {
+        "id": upload_id,
+        "owner": session["username"],
+        "filename": filename,
+        "size": size,
+        "probe": None,
+        "created_at": now,
+        "updated_at": now
+    })
+    open(upload_part_path(upload_id), "wb").close()
+    return jsonify({"upload_id": upload_id, "offset": 0, "size": size, "chunk_size": UPLOAD_CHUNK_BYTES}), 201
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def upload_progress(upload_id):
+    upload_session, error = load_upload_session(upload_id)
+    if error:
+        return error
+    return jsonify({"upload_id": upload_id, "offset": os.path.getsize(upload_part_path(upload_id)),
+                    "size": upload_session["size"], "chunk_size": UPLOAD_CHUNK_BYTES})
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    upload_session, error = load_upload_session(upload_id)
+    if error:
+        return error
+    offset = request.headers.get("Upload-Offset", type=int)
+    part_path = upload_part_path(upload_id)
+
+    with storage.FileLock(part_path + ".lock"):
+        received = os.path.getsize(part_path)
+        if offset != received:
+            return jsonify({"error": "Wrong offset, resume from the one given.", "offset": received}), 409
+        # stream to disk a block at a time, stopping at the declared size
+        with open(part_path, "ab") as f:
+            while True:
+                block = request.stream.read(UPLOAD_BLOCK_BYTES)
+                if not block:
+                    break
+                if f.tell() + len(block) > upload_session["size"]:
+                    f.truncate(received)
+                    return jsonify({"error": "More data than the declared size.", "offset": received}), 413
+                f.write(block)
+            received = f.tell()
+
+    # turn hopeless uploads away as soon as their headers are in
+    if not upload_session["probe"]:
+        info = probe.probe_partial(part_path)
+        if info:
+            error = check_upload(info)
+            if error:
+                discard_upload(upload_id)
+                return jsonify({"error": error}), 400
+            upload_session["probe"] = info
+    upload_session["updated_at"] = datetime.utcnow().isoformat()
+    upload_sessions.put(upload_id, upload_session)
+    return jsonify({"upload_id": upload_id, "offset": received, "size": upload_session["size"]})
+
+@app.route("/uploads/<upload_id>/finalize", methods=["POST"])
+def finish_upload(upload_id):
+    upload_session, error = load_upload_session(upload_id)
+    if error:
+        return error
+    title = request.form.get("title")
+    if not title:
+        return jsonify({"error": "Title is required."}), 400
+    part_path = upload_part_path(upload_id)
+    received = os.path.getsize(part_path)
+    if received != upload_session["size"]:
+        return jsonify({"error": "Upload isn't complete yet.", "offset": received}), 409
 
-        os.remove(temp_path)
-        os.rename(square_path, final_path)
+    try:
+        info = probe.probe_video(part_path)
+        error = check_upload(info)
+    except probe.ProbeError as e:
+        info, error = None, f"Couldn't read that video: {e}."
+    if error:
+        discard_upload(upload_id)
+        return jsonify({"error": error}), 400
 
-    except Exception as e:
-        print("FFmpeg processing failed:", e)
-        os.rename(temp_path, final_path)  # fallback to raw upload
+    video_id = str(uuid.uuid4())
+    ext = os.path.splitext(upload_session["filename"])[1].lower()
+    create_video(video_id, part_path, media.content_hash(part_path), ext, info,
+                 title, request.form.get("description", ""), request.files.get("thumbnail"))
+    discard_upload(upload_id)
+    return jsonify({"video_id": video_id, "url": url_for("video_page", video_id=video_id)})
+
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def cancel_upload(upload_id):
+    upload_session, error = load_upload_session(upload_id)
+    if error:
+        return error
+    discard_upload(upload_id)
+    return jsonify({"success": True})
 
-    # Thumbnail: either user-provided or auto-generated
-    if thumbnail_file:
-        thumb_filename = secure_filename(thumbnail_file.filename)
-        thumbnail_file.save(os.path.join(THUMB_FOLDER, thumb_filename))
+@app.route("/media/<kind>/<path:filename>")
+def media_file(kind, filename):
+    # Videos, thumbnails and HLS files. Content-addressed names and HLS
+    # folders (written once, before the video is published) are cached for
+    # good, anything else is revalidated against its ETag.
+    folder = MEDIA_FOLDERS.get(kind)
+    path = safe_join(folder, filename) if folder else None
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    content_addressed = CONTENT_NAME_RE.match(filename)
+    if MEDIA_OFFLOAD == "x-accel":
+        # nginx does ranges and conditional requests itself
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+        response.headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_PREFIX}{kind}/{filename}"
     else:
-        thumb_filename = final_filename.rsplit(".", 1)[0] + ".png"
-        thumb_path = os.path.join(THUMB_FOLDER, thumb_filename)
-        try:
-            (
-                ffmpeg
-                .input(final_path, ss=0)
-                .filter('scale', 320, -1)
-                .output(thumb_path, vframes=1)
-                .overwrite_output()
-                .run(quiet=True)
-            )
-        except Exception as e:
-            print("Thumbnail generation failed:", e)
-            thumb_filename = None
-
-    # Notify followers
-    users = load_users()
-    for follower in users[session["username"]].get("followers", []):
-        follower_data = users.get(follower)
-        follower_data.setdefault("notifications", []).append({
-            "id": str(uuid.uuid4()),
-            "type": "upload",
-            "from_user": session["username"],
-            "video_id": video_id,
-            "video_title": title,
-            "timestamp": datetime.utcnow().isoformat(),
-            "read": False
-        })
-    save_users(users)
+        # Range/206, If-None-Match and If-Range are handled by send_file,
+        # the content hash doubles as a strong ETag
+        response = send_from_directory(
+            folder, filename, conditional=True,
+            etag=filename.split(".", 1)[0] if content_addressed else True
+        )
 
-    # Save video metadata
-    videos = load_videos()
-    videos.append({
-        "id": video_id,
-        "title": title,
-        "description": description,
-        "video": final_filename,
-        "thumbnail": thumb_filename,
-        "uploader": session["username"],
-        "views": 0,
-        "likes": 0,
-        "dislikes": 0,
-        "liked_by": [],
-        "disliked_by": [],
-        "uploaded_at": datetime.utcnow().isoformat(),
-        "comments": []
-    })
-    save_videos(videos)
+    if content_addressed or kind == "hls":
+        response.headers["Cache-Control"] = f"public, max-age={MEDIA_IMMUTABLE_AGE}, immutable"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
 
-    return redirect("/")
+@app.route("/video/<video_id>/status")
+def video_status(video_id):
+    video = load_video(video_id)
+    if not video:
+        return jsonify({"error": "Video not found"}), 404
+    status = {"status": video.get("status", "ready"), "stage": video.get("status", "ready"), "error": video.get("error")}
+    job = transcode_queue.get(video["job_id"]) if video.get("job_id") else None
+    if job and status["status"] == "processing":
+        status.update(stage=job["stage"], attempt=job["attempt"], max_attempts=job["max_attempts"], error=job["error"])
+    return jsonify(status)
 
 @app.route("/delete_video/<video_id>", methods=["POST"])
+@atomic
 def delete_video(video_id):
     if "username" not in session:
         return "You must be logged in to delete videos.", 403
 
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = load_video(video_id)
     if not video:
         return "Video not found", 404
 
     if video["uploader"] != session["username"]:
         return "You are not allowed to delete this video.", 403
 
-    # delete files
-    video_path = os.path.join(VIDEO_FOLDER, video["video"])
-    if os.path.exists(video_path):
-        os.remove(video_path)
-
-    # If thumbnail exists, delete it
-    if video.get("thumbnail"):
-        thumb_path = os.path.join(THUMB_FOLDER, video["thumbnail"])
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
+    # delete files (a video still processing has none yet, its job cleans up)
+    delete_video_files(video)
 
-    # remove video from list and save
-    videos = [v for v in videos if v["id"] != video_id]
-    save_videos(videos)
+    # remove video record
+    remove_video(video_id)
 
     return redirect(url_for("index"))
 
@@ -461,8 +1241,7 @@ def edit_video(video_id):
     if "username" not in session:
         return redirect(url_for("login"))
 
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = load_video(video_id)
     if not video:
         return "Video not found", 404
 
@@ -477,73 +1256,52 @@ def edit_video(video_id):
             return "Title cannot be empty.", 400
 
         # update video
-        video["title"] = title
-        video["description"] = description
-        save_videos(videos)
+        with store.transaction():
+            video = load_video(video_id)
+            if not video:
+                return "Video not found", 404
+            video["title"] = title
+            video["description"] = description
+            save_video(video)
+            index_video(video)
         return redirect(url_for("video_page", video_id=video_id))
 
     return render_template("edit_video.html", video=video)
 
-@app.route("/like/<video_id>", methods=["POST"])
-def like_video(video_id):
+def vote_video(video_id, value):
     if "username" not in session:
         return jsonify({"error": "Not logged in"}), 403
 
     username = session["username"]
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = load_video(video_id)
     if not video:
         return jsonify({"error": "Video not found"}), 404
 
-    # Toggle logic
-    if username in video.get("liked_by", []):
-        video["liked_by"].remove(username)  # unlike
-    else:
-        video.setdefault("liked_by", []).append(username)
-        if username in video.get("disliked_by", []):
-            video["disliked_by"].remove(username)  # remove dislike if any
-
-    video["likes"] = len(video.get("liked_by", []))
-    video["dislikes"] = len(video.get("disliked_by", []))
-    save_videos(videos)
+    # voting the same way again takes the vote back, a like replaces a dislike
+    old, new = vote_store.toggle(votes.video_target(video_id), username, value, video_id)
+    votes.count(video, old, new)
+    save_video(video)
+    creator_board.likes_changed(video["uploader"], (new == votes.LIKE) - (old == votes.LIKE))
 
     return jsonify({
         "likes": video["likes"],
         "dislikes": video["dislikes"],
-        "following_like": username in video.get("liked_by", []),
-        "following_dislike": username in video.get("disliked_by", [])
+        "following_like": new == votes.LIKE,
+        "following_dislike": new == votes.DISLIKE
     })
 
+@app.route("/like/<video_id>", methods=["POST"])
+@atomic
+def like_video(video_id):
+    return vote_video(video_id, votes.LIKE)
+
 @app.route("/dislike/<video_id>", methods=["POST"])
+@atomic
 def dislike_video(video_id):
-    if "username" not in session:
-        return jsonify({"error": "Not logged in"}), 403
-
-    username = session["username"]
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
-    if not video:
-        return jsonify({"error": "Video not found"}), 404
-
-    if username in video.get("disliked_by", []):
-        video["disliked_by"].remove(username)  # undislike
-    else:
-        video.setdefault("disliked_by", []).append(username)
-        if username in video.get("liked_by", []):
-            video["liked_by"].remove(username)  # remove like if any
-
-    video["likes"] = len(video.get("liked_by", []))
-    video["dislikes"] = len(video.get("disliked_by", []))
-    save_videos(videos)
-
-    return jsonify({
-        "likes": video["likes"],
-        "dislikes": video["dislikes"],
-        "following_like": username in video.get("liked_by", []),
-        "following_dislike": username in video.get("disliked_by", [])
-    })
+    return vote_video(video_id, votes.DISLIKE)
 
 @app.route("/comment/<video_id>", methods=["POST"])
+@atomic
 def post_comment(video_id):
     if "username" not in session:
         return jsonify({"error": "Login required"}), 403
@@ -554,203 +1312,112 @@ def post_comment(video_id):
     if not text:
         return jsonify({"error": "Comment cannot be empty"}), 400
 
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = load_video(video_id)
     if not video:
         return jsonify({"error": "Video not found"}), 404
 
-    comment_id = str(uuid.uuid4())
-    new_comment = {
-        "id": comment_id,
-        "author": session["username"],
-        "text": text,
-        "timestamp": datetime.utcnow().isoformat(),
-        "likes": 0,
-        "dislikes": 0,
-        "liked_by": [],
-        "disliked_by": [],
-        "replies": []
-    }
-
+    parent = None
     if parent_id:
-        # Find the parent comment and add reply
-        def find_comment(comments, pid):
-            for c in comments:
-                if c["id"] == pid:
-                    return c
-                r = find_comment(c.get("replies", []), pid)
-                if r:
-                    return r
-            return None
-
-        parent = find_comment(video.get("comments", []), parent_id)
-        if parent:
-            parent.setdefault("replies", []).append(new_comment)
-        else:
+        parent = comment_store.get(parent_id)
+        if not parent or parent["video_id"] != video_id:
             return jsonify({"error": "Parent comment not found"}), 404
-    else:
-        video.setdefault("comments", []).append(new_comment)
+
+    new_comment = comment_store.add(video_id, session["username"], text, parent)
 
     if video["uploader"] != session["username"]:
-        users = load_users()
-        uploader_data = users.get(video["uploader"])
-        uploader_data.setdefault("notifications", [])
-        uploader_data["notifications"].append({
-            "id": str(uuid.uuid4()),
+        notification_store.add(video["uploader"], {
             "type": "comment",
             "from_user": session["username"],
             "video_id": video["id"],
-            "video_title": video["title"],
-            "timestamp": datetime.utcnow().isoformat(),
-            "read": False
+            "video_title": video["title"]
         })
-        save_users(users)
 
-    save_videos(videos)
     return jsonify({"success": True, "comment": new_comment})
 
-@app.route("/comment_like/<video_id>/<comment_id>", methods=["POST"])
-def like_comment(video_id, comment_id):
+def vote_comment(video_id, comment_id, value):
     if "username" not in session:
         return jsonify({"error": "Login required"}), 403
     username = session["username"]
 
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
-    if not video:
-        return jsonify({"error": "Video not found"}), 404
-
-    def find_comment(comments, cid):
-        for c in comments:
-            if c["id"] == cid:
-                return c
-            r = find_comment(c.get("replies", []), cid)
-            if r:
-                return r
-        return None
-
-    comment = find_comment(video.get("comments", []), comment_id)
-    if not comment:
+    comment = comment_store.get(comment_id)
+    if not comment or comment["video_id"] != video_id:
         return jsonify({"error": "Comment not found"}), 404
 
-    # Toggle like
-    if username in comment.get("liked_by", []):
-        comment["liked_by"].remove(username)
-    else:
-        comment.setdefault("liked_by", []).append(username)
-        if username in comment.get("disliked_by", []):
-            comment["disliked_by"].remove(username)
-
-    comment["likes"] = len(comment.get("liked_by", []))
-    comment["dislikes"] = len(comment.get("disliked_by", []))
-    save_videos(videos)
+    old, new = vote_store.toggle(votes.comment_target(comment_id), username, value, video_id)
+    comment = storage.thaw(comment)
+    votes.count(comment, old, new)
+    comment_store.put(comment)
 
     return jsonify({
         "likes": comment["likes"],
         "dislikes": comment["dislikes"],
-        "following_like": username in comment.get("liked_by", []),
-        "following_dislike": username in comment.get("disliked_by", [])
+        "following_like": new == votes.LIKE,
+        "following_dislike": new == votes.DISLIKE
     })
 
+@app.route("/comment_like/<video_id>/<comment_id>", methods=["POST"])
+@atomic
+def like_comment(video_id, comment_id):
+    return vote_comment(video_id, comment_id, votes.LIKE)
+
 @app.route("/comment_dislike/<video_id>/<comment_id>", methods=["POST"])
+@atomic
 def dislike_comment(video_id, comment_id):
-    if "username" not in session:
-        return jsonify({"error": "Login required"}), 403
-    username = session["username"]
-
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
-    if not video:
-        return jsonify({"error": "Video not found"}), 404
-
-    def find_comment(comments, cid):
-        for c in comments:
-            if c["id"] == cid:
-                return c
-            r = find_comment(c.get("replies", []), cid)
-            if r:
-                return r
-        return None
-
-    comment = find_comment(video.get("comments", []), comment_id)
-    if not comment:
-        return jsonify({"error": "Comment not found"}), 404
-
-    # Toggle dislike
-    if username in comment.get("disliked_by", []):
-        comment["disliked_by"].remove(username)
-    else:
-        comment.setdefault("disliked_by", []).append(username)
-        if username in comment.get("liked_by", []):
-            comment["liked_by"].remove(username)
-
-    comment["likes"] = len(comment.get("liked_by", []))
-    comment["dislikes"] = len(comment.get("disliked_by", []))
-    save_videos(videos)
-
-    return jsonify({
-        "likes": comment["likes"],
-        "dislikes": comment["dislikes"],
-        "following_like": username in comment.get("liked_by", []),
-        "following_dislike": username in comment.get("disliked_by", [])
-    })
+    return vote_comment(video_id, comment_id, votes.DISLIKE)
 
 @app.route("/delete_comment/<video_id>/<comment_id>", methods=["POST"])
+@atomic
 def delete_comment(video_id, comment_id):
     if "username" not in session:
         return jsonify({"error": "Login required"}), 403
     username = session["username"]
 
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
-    if not video:
-        return jsonify({"error": "Video not found"}), 404
-
-    def delete_comment_recursive(comments, cid):
-        for i, c in enumerate(comments):
-            if c["id"] == cid:
-                if c["author"] != username:
-                    return False  # only author can delete
-                del comments[i]
-                return True
-            if delete_comment_recursive(c.get("replies", []), cid):
-                return True
-        return False
-
-    success = delete_comment_recursive(video.get("comments", []), comment_id)
-    if not success:
+    comment = comment_store.get(comment_id)
+    # only the author can delete
+    if not comment or comment["video_id"] != video_id or comment["author"] != username:
         return jsonify({"error": "Comment not found or permission denied"}), 404
 
-    save_videos(videos)
+    # replies and the votes on all of it go too
+    removed = comment_store.remove(comment)
+    vote_store.remove_targets(votes.comment_target(cid) for cid in removed)
     return jsonify({"success": True})
 
 @app.route("/user/<username>")
 def user_profile(username):
-    users = load_users()
-    ensure_user_fields(users)
-    user_data = users.get(username)
+    user_data = load_user(username)
     if not user_data:
+        # /user/bob finds Bob
+        canonical = user_index.canonical(username)
+        if canonical:
+            return redirect(url_for("user_profile", username=canonical, **request.args))
         return "User not found", 404
 
     # block non-admins from finding shadowbanned user pages except when owner views
     if user_data.get("shadowbanned", False) and not (is_admin(session.get("username")) or session.get("username")==username):
         return "User not found", 404
 
-    videos = load_videos()
-    user_videos = sorted([v for v in videos if v.get("uploader", "").lower() == username.lower()], key=lambda v: v.get("uploaded_at", 0), reverse=True)
+    after = decode_cursor(request.args.get("after"))
+    page, next_after = user_videos_page(username, after)
+    user_videos = [dict(v) for v in page]
 
     for v in user_videos:
         v["uploaded_ago"] = time_since(v.get("uploaded_at", datetime.utcnow()))
+        v["views"] = view_counter.views(v)
 
     logged_in = "username" in session
     session_username = session.get("username")
+    followers_count, following_count = follow_graph.count(username)
 
     return render_template(
         "profile.html",
         username=username,
         user=user_data,
         videos=user_videos,
-        not_found=len(user_videos) == 0,
+        followers_count=followers_count,
+        following_count=following_count,
+        is_following=follow_graph.is_following(session_username, username),
+        not_found=len(user_videos) == 0 and after is None,
+        next_cursor=encode_cursor(next_after) if next_after else None,
         logged_in=logged_in,
         session_username=session_username
     )
@@ -760,9 +1427,8 @@ def edit_profile():
     if "username" not in session:
         return redirect(url_for("login"))
 
-    users = load_users()
     current_username = session["username"]
-    user_data = users.get(current_username)
+    user_data = load_user(current_username)
 
     if not user_data:
         return "User not found.", 404
@@ -772,26 +1438,34 @@ def edit_profile():
         bio = request.form.get("bio", "")
         profile_pic_file = request.files.get("profile_pic")
 
-        # Change username if different
-        if new_username and new_username != current_username:
-            if new_username in users:
-                return "Username already taken.", 400
-
-            users[new_username] = user_data  # copy existing data
-            del users[current_username]
-            session["username"] = new_username
-            current_username = new_username
-
-        # Update bio
-        users[current_username]["bio"] = bio
-
-        # Update profile picture
+        # Save the profile picture first, outside the transaction
+        profile_pic = None
         if profile_pic_file:
-            filename = secure_filename(profile_pic_file.filename)
-            profile_pic_file.save(os.path.join("static/profile_pics", filename))
-            users[current_username]["profile_pic"] = filename
-
-        save_users(users)
+            profile_pic = secure_filename(profile_pic_file.filename)
+            profile_pic_file.save(os.path.join("static/profile_pics", profile_pic))
+
+        with store.transaction():
+            user_data = load_user(current_username)
+            if not user_data:
+                return "User not found.", 404
+
+            # Change username if different
+            if new_username and new_username != current_username:
+                if load_user(new_username):
+                    return "Username already taken.", 400
+
+                remove_user(current_username)  # data is saved under the new name below
+                follow_graph.rename(current_username, new_username)
+                timelines.rename(current_username, new_username)
+                session["username"] = new_username
+                current_username = new_username
+
+            # Update bio and profile picture
+            user_data["bio"] = bio
+            if profile_pic:
+                user_data["profile_pic"] = profile_pic
+
+            save_user(current_username, user_data)
         return redirect(url_for("user_profile", username=current_username))
 
     return render_template("edit_profile.html", user=user_data)
@@ -800,82 +1474,39 @@ def edit_profile():
 def profiles():
     query = request.args.get("q", "").strip().lower()
 
-    users = load_users()
-
-    # Load videos
-    with open("videos.json", "r") as f:
-        videos = json.load(f)
-
-    stats = {}
-    now = datetime.utcnow()
+    # ranked from the leaderboard, only this page's users get loaded
+    if query:
+        entries, next_after = creator_board.search(query, PROFILES_PAGE_SIZE), None
+    else:
+        after = decode_cursor(request.args.get("after"))
+        entries, next_after = creator_board.page(after, PROFILES_PAGE_SIZE)
 
-    # --- Build uploader stats ---
-    for v in videos:
-        uploader = v["uploader"]
-        if uploader not in stats:
-            stats[uploader] = {"uploads": 0, "likes": 0, "last_upload": None}
-        stats[uploader]["uploads"] += 1
-        stats[uploader]["likes"] += v.get("likes", 0)
-
-        uploaded_at = v.get("uploaded_at")
-        if isinstance(uploaded_at, str):
-            try:
-                uploaded_dt = datetime.fromisoformat(uploaded_at)
-            except ValueError:
-                uploaded_dt = None
-            if uploaded_dt and (
-                stats[uploader]["last_upload"] is None or uploaded_dt > stats[uploader]["last_upload"]
-            ):
-                stats[uploader]["last_upload"] = uploaded_dt
-
-    # --- Build user list ---
     user_list = []
-    for username, data in users.items():
-        is_shadowbanned = data.get("shadowbanned", False)
-        uploads = stats.get(username, {}).get("uploads", 0)
-        likes = stats.get(username, {}).get("likes", 0)
-        last_upload = stats.get(username, {}).get("last_upload")
-
-        # Skip users with no uploads
-        if not last_upload:
+    for entry in entries:
+        data = load_user(entry["username"])
+        if not data:
             continue
-
-        # Calculate inactivity (days since last upload)
-        days_since_upload = (now - last_upload).days if last_upload else 9999
-        if days_since_upload > 60:
-            continue  # hide inactive users
-
-        # Recency score (the more recent, the higher)
-        recency_score = 100 / max(days_since_upload, 1)
-
-        # Popularity formula
-        popularity = (likes * 3) + (uploads * 2) + recency_score
-
-        if not is_shadowbanned:
-            user_list.append({
-                "username": username,
-                "bio": data.get("bio", ""),
-                "profile_pic": data.get("profile_pic", None),
-                "uploads": uploads,
-                "likes": likes,
-                "last_upload": last_upload,
-                "popularity": round(popularity, 2),
-                "days_since_upload": days_since_upload
-            })
-
-    # --- Filter and sort ---
-    if query:
-        user_list = [u for u in user_list if query in u["username"].lower()]
-
-    user_list.sort(key=lambda u: u["popularity"], reverse=True)
+        user_list.append({
+            "username": entry["username"],
+            "bio": data.get("bio", ""),
+            "profile_pic": data.get("profile_pic", None),
+            "uploads": entry["uploads"],
+            "likes": entry["likes"],
+            "last_upload": entry["last_upload"],
+            "popularity": entry["score"],
+            "days_since_upload": entry["days_since_upload"]
+        })
 
     # --- Always return something ---
     if not user_list:
         return render_template("profiles.html", users=[], search_query=query, message="No active profiles found.")
 
-    return render_template("profiles.html", users=user_list, search_query=query)
+    following = follow_graph.following_among(session.get("username"), [u["username"] for u in user_list])
+    return render_template("profiles.html", users=user_list, search_query=query, following=following,
+                           next_cursor=encode_cursor(next_after) if next_after else None)
 
 @app.route("/follow/<username>", methods=["POST"])
+@atomic
 def toggle_follow(username):
     if "username" not in session:
         return jsonify({"error": "Not logged in"}), 403
@@ -884,61 +1515,88 @@ def toggle_follow(username):
     if current_user == username:
         return jsonify({"error": "Cannot follow yourself"}), 400
 
-    users = load_users()
-    ensure_user_fields(users)
-
-    follower = users.get(current_user)
-    target = users.get(username)
-
-    if not target:
+    if not load_user(username):
         return jsonify({"error": "User not found"}), 404
 
-    # Toggle follow
-    if current_user in target["followers"]:
-        target["followers"].remove(current_user)
-        follower["following"].remove(username)
-        following = False
-    else:
-        target["followers"].append(current_user)
-        follower["following"].append(username)
-        following = True
-
-    save_users(users)
+    following = follow_graph.toggle(current_user, username)
+    if not following:
+        timelines.unfollowed(current_user, username)
+    elif not timelines.is_large(username):
+        recent = store.videos.find(where={"uploader": username}, order_by=("uploaded_at",), desc=True,
+                                   limit=FEED_BACKFILL)
+        timelines.backfill(current_user, [video for _, video in recent])
 
     return jsonify({
         "following": following,
-        "followers_count": len(target["followers"])
+        "followers_count": follow_graph.count(username)[0]
     })
 
+def follow_list(username, page):
+    # page(username, after, limit) is follow_graph.followers or .following
+    if not load_user(username):
+        return jsonify({"error": "User not found"}), 404
+    after = decode_cursor(request.args.get("after"))
+    limit = max(1, min(request.args.get("limit", FOLLOWS_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    names, next_after = page(username, after, limit)
+    return jsonify({
+        "users": names,
+        "next": encode_cursor(next_after) if next_after else None
+    })
+
+@app.route("/user/<username>/followers")
+def user_followers(username):
+    return follow_list(username, follow_graph.followers)
+
+@app.route("/user/<username>/following")
+def user_following(username):
+    return follow_list(username, follow_graph.following)
+
+@app.route("/following/check")
+def following_check():
+    # ?u=alice&u=bob -> which of them the viewer follows
+    names = request.args.getlist("u")[:MAX_PAGE_SIZE]
+    following = follow_graph.following_among(session.get("username"), names)
+    return jsonify({name: name in following for name in names})
+
 @app.route("/notifications")
 def notifications():
     if "username" not in session:
         return redirect(url_for("login"))
 
-    users = load_users()
-    user_data = users[session["username"]]
-    notifications = sorted(user_data.get("notifications", []),
-                           key=lambda n: n["timestamp"], reverse=True)
-    
+    username = session["username"]
+    after = decode_cursor(request.args.get("after"))
+    page, next_after = notification_store.page(username, after, NOTIFICATIONS_PAGE_SIZE)
+
     # Map type to emoji
     emoji_map = {"like": "👍", "comment": "💬", "upload": "📤"}
-    
-    for n in notifications:
-        n["emoji"] = emoji_map.get(n["type"], "🔔")
-
-    unread_count = sum(1 for n in notifications if not n["read"])
 
     return render_template("notifications.html",
-                           notifications=notifications,
-                           unread_count=unread_count)
+                           notifications=page,
+                           emoji_map=emoji_map,
+                           next_after=encode_cursor(next_after) if next_after else None,
+                           unread_count=notification_store.unread_count(username))
+
+@app.route("/notifications/read", methods=["POST"])
+def mark_notifications_read():
+    # ids=<id>&ids=<id> as a form, {"ids": [...]} or a bare [...] as JSON
+    # marks those, nothing marks them all
+    if "username" not in session:
+        return jsonify({"error": "Not logged in"}), 403
+    username = session["username"]
+    body = request.get_json(silent=True)
+    ids = body.get("ids") if isinstance(body, dict) else body
+    if ids is not None and not (isinstance(ids, list) and all(isinstance(i, str) for i in ids)):
+        return jsonify({"error": "ids must be a list of notification ids"}), 400
+    ids = ids or request.form.getlist("ids") or None
+    marked = notification_store.mark_read(username, ids)
+    if request.is_json or request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return jsonify({"marked": marked, "unread_count": notification_store.unread_count(username)})
+    return redirect(url_for("notifications"))
 
 @app.context_processor
 def inject_notifications():
     if "username" in session:
-        users = load_users()
-        user_data = users.get(session["username"], {})
-        unread_count = sum(1 for n in user_data.get("notifications", []) if not n.get("read", False))
-        return {"unread_count": unread_count}
+        return {"unread_count": notification_store.unread_count(session["username"])}
     return {"unread_count": 0}
 
 from werkzeug.security import generate_password_hash
@@ -952,8 +1610,7 @@ def recover_account():
     if request.method == "POST":
         action = request.form.get("action")
         username = request.form.get("username").strip()
-        users = load_users()
-        user = users.get(username)
+        user = load_user(username)
 
         if not user:
             return "User not found", 404
@@ -961,8 +1618,12 @@ def recover_account():
         if action == "generate_code":
             # Generate a 6-character alphanumeric code
             recovery_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-            user["recovery_code"] = recovery_code
-            save_users(users)
+            with store.transaction():
+                user = load_user(username)
+                if not user:
+                    return "User not found", 404
+                user["recovery_code"] = recovery_code
+                save_user(username, user)
             code_generated = True
 
         elif action == "reset_password":
@@ -972,9 +1633,16 @@ def recover_account():
             if user.get("recovery_code") != code:
                 return "Invalid recovery code", 400
 
-            user["password"] = generate_password_hash(new_password)
-            user.pop("recovery_code", None)
-            save_users(users)
+            # hashing is slow, done before the transaction
+            hashed = generate_password_hash(new_password)
+            with store.transaction():
+                # the code is checked again, it may have been used meanwhile
+                user = load_user(username)
+                if not user or user.get("recovery_code") != code:
+                    return "Invalid recovery code", 400
+                user["password"] = hashed
+                user.pop("recovery_code", None)
+                save_user(username, user)
             return "Password reset successful! You can now log in."
 
     return render_template(
@@ -986,8 +1654,7 @@ def recover_account():
 
 @app.route("/show_recovery_code/<username>")
 def show_recovery_code(username):
-    users = load_users()
-    user = users.get(username)
+    user = load_user(username)
     if not user or "recovery_code" not in user:
         return "No recovery code found for this user."
 
@@ -996,14 +1663,12 @@ def show_recovery_code(username):
 
 @app.route("/recover_username", methods=["GET", "POST"])
 def recover_username():
-    users = load_users()
     message = None
     error = None
 
     if request.method == "POST":
-        hint = request.form.get("hint", "").strip().lower()
         # Find all users matching the hint
-        matching_users = [u for u, data in users.items() if data.get("hint", "").lower() == hint]
+        matching_users = user_index.with_hint(request.form.get("hint", ""))
 
         if matching_users:
             message = f"Your username(s): {', '.join(matching_users)}"
@@ -1014,57 +1679,52 @@ def recover_username():
 
 @app.route("/generate_recovery_code/<username>")
 def generate_recovery_code(username):
-    users = load_users()
-    user = users.get(username)
-
-    if not user:
-        return "User not found.", 404
-
     # Generate a random 6-digit code (or alphanumeric)
     code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    
+
     # Save it in the user data
-    user['recovery_code'] = code
-    save_users(users)
+    with store.transaction():
+        user = load_user(username)
+        if not user:
+            return "User not found.", 404
+        user['recovery_code'] = code
+        save_user(username, user)
 
     return f"Recovery code generated: {code}"
 
+def remove_account(username):
+    # Delete user's videos and associated files, a transaction each so other
+    # requests get a turn in between
+    for video_id in user_video_ids(username):
+        with store.transaction():
+            video = load_video(video_id)
+            if video:
+                delete_video_files(video)
+                remove_video(video_id)
+
+    with store.transaction():
+        # Delete user's notifications, and the ones they sent to other users
+        notification_store.remove_user(username)
+        creator_board.remove(username)
+        follow_graph.remove_user(username)
+        timelines.remove_user(username)
+
+        # Finally, delete user account
+        remove_user(username)
+
 @app.route("/delete_account", methods=["GET", "POST"])
 def delete_account():
     if "username" not in session:
         return redirect(url_for("login"))
 
     username = session["username"]
-    users = load_users()
-    videos = load_videos()
 
     if request.method == "POST":
         confirm_text = request.form.get("confirm_text", "").strip()
         if confirm_text != "DELETE":
             return "You must type DELETE to confirm.", 400
 
-        # Delete user's videos and associated files
-        user_videos = [v for v in videos if v["uploader"] == username]
-        for v in user_videos:
-            video_path = os.path.join("static/videos", v["video"])
-            if os.path.exists(video_path):
-                os.remove(video_path)
-            if v.get("thumbnail"):
-                thumb_path = os.path.join("static/thumbnails", v["thumbnail"])
-                if os.path.exists(thumb_path):
-                    os.remove(thumb_path)
-        # Remove videos from list
-        videos = [v for v in videos if v["uploader"] != username]
-        save_videos(videos)
-
-        # Delete user's notifications from other users
-        for u, data in users.items():
-            if "notifications" in data:
-                data["notifications"] = [n for n in data["notifications"] if n.get("from_user") != username]
-
-        # Finally, delete user account
-        users.pop(username, None)
-        save_users(users)
+        remove_account(username)
 
         # Log out
         session.pop("username", None)
@@ -1092,69 +1752,50 @@ def admin_dashboard():
     users = load_users()
     videos = load_videos()
     # show important stats; templates can list them
-    return render_template("admin_dashboard.html", users=users, videos=videos)
+    return render_template("admin_dashboard.html", users=users, videos=videos,
+                           followers={u: follow_graph.count(u)[0] for u in users})
 
 @app.route("/admin/delete_video/<video_id>", methods=["POST"])
 @require_admin
+@atomic
 def admin_delete_video(video_id):
-    videos = load_videos()
-    video = next((v for v in videos if v["id"] == video_id), None)
+    video = load_video(video_id)
     if not video:
         return jsonify({"error": "Video not found"}), 404
 
     # delete files
-    video_path = os.path.join(VIDEO_FOLDER, video["video"])
-    if os.path.exists(video_path):
-        os.remove(video_path)
+    delete_video_files(video)
 
-    if video.get("thumbnail"):
-        thumb_path = os.path.join(THUMB_FOLDER, video["thumbnail"])
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
-
-    videos = [v for v in videos if v["id"] != video_id]
-    save_videos(videos)
+    remove_video(video_id)
     return jsonify({"success": True})
 
 @app.route("/admin/delete_user/<username_to_delete>", methods=["POST"])
 @require_admin
 def admin_delete_user(username_to_delete):
-    users = load_users()
-    if username_to_delete not in users:
+    if not load_user(username_to_delete):
         return jsonify({"error": "User not found"}), 404
 
-    # delete user's videos
-    videos = load_videos()
-    to_delete_videos = [v for v in videos if v.get("uploader") == username_to_delete]
-    for v in to_delete_videos:
-        video_path = os.path.join(VIDEO_FOLDER, v["video"])
-        if os.path.exists(video_path):
-            os.remove(video_path)
-        if v.get("thumbnail"):
-            thumb_path = os.path.join(THUMB_FOLDER, v["thumbnail"])
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
-
-    videos = [v for v in videos if v.get("uploader") != username_to_delete]
-    save_videos(videos)
-
-    # remove user record
-    del users[username_to_delete]
-    save_users(users)
+    # user's videos, their records and the user record
+    remove_account(username_to_delete)
     return jsonify({"success": True})
 
 @app.route("/admin/toggle_shadowban/<username_to_toggle>", methods=["POST"])
 @require_admin
+@atomic
 def admin_toggle_shadowban(username_to_toggle):
-    users = load_users()
-    if username_to_toggle not in users:
+    user = load_user(username_to_toggle)
+    if not user:
         return jsonify({"error": "User not found"}), 404
 
-    users[username_to_toggle].setdefault("shadowbanned", False)
-    users[username_to_toggle]["shadowbanned"] = not users[username_to_toggle]["shadowbanned"]
-    save_users(users)
+    user["shadowbanned"] = not user.get("shadowbanned", False)
+    save_user(username_to_toggle, user)
+
+    # shadowbanned videos are kept out of the search index and the leaderboard
+    for _, video in store.videos.find(where={"uploader": username_to_toggle}):
+        search_index.index_video(video, hidden=user["shadowbanned"])
+    creator_board.set_hidden(username_to_toggle, user["shadowbanned"])
 
-    return jsonify({"success": True, "shadowbanned": users[username_to_toggle]["shadowbanned"]})
+    return jsonify({"success": True, "shadowbanned": user["shadowbanned"]})
 
 @app.context_processor
 def inject_helpers():
@@ -1163,6 +1804,78 @@ def inject_helpers():
         "is_moderator": lambda u: is_moderator(u)
     }
 
+@app.cli.command("import-json")
+def import_json_command():
+    """Copy videos.json, users.json and admins.json into the sqlite store."""
+    if store.backend != "sqlite":
+        print("ENIV_STORAGE is not sqlite, nothing to import into.")
+        return
+    counts = storage.import_json(store)
+    print(", ".join(f"{count} {name}" for name, count in counts.items()) + " imported.")
+    # the json files can be in any older shape, migrate them from scratch
+    store.set_meta("schema_version", "0")
+    migrate_schema()
+    rebuild_search_index()
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Bring stored records up to the current schema version."""
+    applied = migrate_schema()
+    print(f"Applied {', '.join(applied)}." if applied else "Schema is up to date.")
+    print(f"Schema version {store.get_meta('schema_version')}.")
+
+@app.cli.command("reindex-search")
+def reindex_search_command():
+    """Rebuild the video search index from scratch."""
+    rebuild_search_index()
+    print("Search index rebuilt.")
+
+@app.cli.command("repair-notification-counts")
+def repair_notification_counts_command():
+    """Recount every user's unread notifications."""
+    fixed = repair_notification_counts()
+    print(f"Fixed unread counts for {len(fixed)} users" + (f": {', '.join(fixed)}" if fixed else "."))
+
+@app.cli.command("reconcile-storage")
+@click.option("--dry-run", is_flag=True, help="Only report what would be cleaned up.")
+@click.option("--batch-size", default=200, show_default=True, help="Files deleted per batch.")
+@click.option("--pause", default=0.5, show_default=True, help="Seconds to wait between batches.")
+def reconcile_storage_command(dry_run, batch_size, pause):
+    """Find and remove orphaned media files, stale uploads and dangling references."""
+    reconciler.batch_size, reconciler.batch_pause = batch_size, pause
+    report = reconciler.run(dry_run=dry_run)
+    for kind, path, size in report["orphans"]:
+        print(f"orphan {kind:<10} {size:>12} {path}")
+    for label, key in (("stale uploads", "expired_uploads"), ("unused media entries", "unused_media"),
+                       ("old failed jobs", "old_jobs"), ("videos with fixed references", "fixed_videos"),
+                       ("videos missing their file", "missing_files")):
+        if report[key]:
+            print(f"{label}: {', '.join(report[key])}")
+    verb = "Would free" if dry_run else "Freed"
+    print(f"{verb} {report['bytes'] / (1024 * 1024):.1f} MB in {len(report['orphans'])} files.")
+
+@app.cli.command("set-role")
+@click.argument("username")
+@click.argument("role", type=click.Choice(sorted(storage.ROLE_LISTS)))
+@click.option("--remove", is_flag=True, help="Take the role away instead.")
+def set_role_command(username, role, remove):
+    """Give a user the admin or moderator role, or take it away with --remove."""
+    with store.transaction():
+        if not remove and not load_user(username):
+            print(f"No user named {username}.")
+            return
+        admins_obj = load_admins()
+        members = admins_obj[storage.ROLE_LISTS[role]]
+        if remove == (username not in members):
+            print(f"{username} {'does not have' if remove else 'already has'} the {role} role.")
+            return
+        if remove:
+            members.remove(username)
+        else:
+            members.append(username)
+        save_admins(admins_obj)
+    print(f"{username} {'no longer has' if remove else 'now has'} the {role} role.")
+
 if __name__ == "__main__":
     # app.run(debug=True)
     # Below is for when I am not testing
@@ -0,0 +1,84 @@
+import uuid
+from datetime import datetime
+
+# ------------------------------
+# Comments
+# ------------------------------
+# Comments are stored flat in the "comments" collection, keyed by id. Each
+# one points at its video and its parent comment (None for top level) and
+# keeps a count of its direct replies, so a page of a thread is one indexed
+# query and nothing ever walks a whole tree.
+#
+# Pages come oldest first, after is the (timestamp, id) of the last comment
+# on the previous page.
+
+
+class CommentStore:
+    def __init__(self, collection):
+        self.comments = collection
+
+    def get(self, comment_id):
+        return self.comments.get(comment_id)
+
+    def put(self, comment):
+        self.comments.put(comment["id"], comment)
+
+    def add(self, video_id, author, text, parent=None):
+        # parent is the comment being replied to, if any
+        comment = {
+            "id": str(uuid.uuid4()),
+            "video_id": video_id,
+            "parent_id": parent["id"] if parent else None,
+            "author": author,
+            "text": text,
+            "timestamp": datetime.utcnow().isoformat(),
+            "likes": 0,
+            "dislikes": 0,
+            "reply_count": 0,
+        }
+        self.comments.put(comment["id"], comment)
+        if parent:
+            self.comments.put(parent["id"], dict(parent, reply_count=parent.get("reply_count", 0) + 1))
+        return comment
+
+    def page(self, video_id, parent_id=None, after=None, limit=20):
+        # one page of comments plus the after of the next page
+        rows, next_after = self.comments.find_page(where={"video_id": video_id, "parent_id": parent_id},
+                                                   order_by=("timestamp",), after=after, limit=limit)
+        return [doc for _, doc in rows], next_after
+
+    def count(self, video_id):
+        return self.comments.count(where={"video_id": video_id})
+
+    def remove(self, comment):
+        # comment and all its replies, returns the ids that were removed
+        removed, pending = [], [comment["id"]]
+        while pending:
+            comment_id = pending.pop()
+            removed.append(comment_id)
+            pending.extend(key for key, _ in self.comments.find(
+                where={"video_id": comment["video_id"], "parent_id": comment_id}))
+        self.comments.delete_many(removed)
+        parent = self.comments.get(comment["parent_id"]) if comment["parent_id"] else None
+        if parent:
+            self.comments.put(parent["id"], dict(parent, reply_count=max(0, parent.get("reply_count", 0) - 1)))
+        return removed
+
+    def remove_video(self, video_id):
+        keys = [key for key, _ in self.comments.find(where={"video_id": video_id})]
+        if keys:
+            self.comments.delete_many(keys)
+
+    def import_tree(self, video_id, comments, parent_id=None):
+        # the nested comments lists older video records kept
+        docs = {}
+        for c in comments:
+            replies = c.get("replies", [])
+            doc = {k: v for k, v in c.items() if k not in ("replies", "current_user_liked", "current_user_disliked")}
+            doc.update(video_id=video_id, parent_id=parent_id, reply_count=len(replies))
+            doc.setdefault("likes", 0)
+            doc.setdefault("dislikes", 0)
+            docs[c["id"]] = doc
+            self.import_tree(video_id, replies, c["id"])
+        if docs:
+            self.comments.put_many(docs)
@@ -0,0 +1,65 @@
+import threading
+import time
+
+# ------------------------------
+# Buffered view counts
+# ------------------------------
+# Page views are counted in memory and written to the store in batches, either
+# every FLUSH_INTERVAL seconds or once FLUSH_THRESHOLD views are pending.
+# Whatever is still pending gets flushed when the process exits cleanly.
+
+class ViewCounter:
+    def __init__(self, collection, flush_interval=10, flush_threshold=100):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def hit(self, video_id):
+        with self._lock:
+            self._pending[video_id] = self._pending.get(video_id, 0) + 1
+            self._total += 1
+            full = self._total >= self.flush_threshold
+        if full:
+            self.flush()
+
+    def pending(self, video_id):
+        return self._pending.get(video_id, 0)
+
+    def views(self, video):
+        # stored count plus what this process hasn't flushed yet
+        return video.get("views", 0) + self.pending(video["id"])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._total = self._pending, {}, 0
+            if not pending:
+                return
+
+            def add_views(video_id, video):
+                video["views"] = video.get("views", 0) + pending[video_id]
+
+            try:
+                self.collection.update_many(list(pending), add_views)
+            except Exception as e:
+                print("Flushing view counts failed:", e)
+                # put them back so the next flush tries again
+                with self._lock:
+                    for video_id, count in pending.items():
+                        self._pending[video_id] = self._pending.get(video_id, 0) + count
+                        self._total += count
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
@@ -0,0 +1,139 @@
+# ------------------------------
+# Following feed
+# ------------------------------
+# Every user's "Following" feed is kept ready in the "timelines" collection,
+# one row per (user, video) keyed "<user>|<video id>". A new upload is written
+# into its uploader's followers' timelines (fan-out on write), and timelines
+# keep the newest limit entries.
+#
+# Creators with large_at followers or more are "large": their uploads aren't
+# copied into anyone's timeline, page() merges their latest videos in when a
+# follower reads instead (fan-out on read). Once large, a creator stays large.
+#
+# Pages come newest first, after is the (uploaded_at, video id) of the last
+# video on the previous page.
+
+
+def _published(video):
+    # records from before uploads were processed in the background have no status
+    return video.get("status") in (None, "ready")
+
+
+class Timelines:
+    def __init__(self, entries, large, videos, limit=500, large_at=5000):
+        self.entries = entries
+        self.large = large
+        self.videos = videos
+        self.limit = limit
+        self.large_at = large_at
+
+    def is_large(self, uploader):
+        return self.large.get(uploader) is not None
+
+    def check_large(self, uploader, followers):
+        # call with the uploader's follower count before fanning out
+        if followers >= self.large_at and not self.is_large(uploader):
+            self.large.put(uploader, {"followers": followers})
+        return self.is_large(uploader)
+
+    def large_creators(self):
+        return [uploader for uploader, _ in self.large.items()]
+
+    def _entry(self, user, video):
+        return {"user": user, "video_id": video["id"], "uploader": video["uploader"],
+                "uploaded_at": video["uploaded_at"]}
+
+    def _trim(self, user):
+        over = self.entries.count(where={"user": user}) - self.limit
+        if over > 0:
+            oldest = self.entries.find(where={"user": user}, order_by=("uploaded_at",), limit=over)
+            self.entries.delete_many([key for key, _ in oldest])
+
+    def add_many(self, users, video):
+        # video into each of users' timelines, a retried batch is a no-op
+        docs = {}
+        for user in users:
+            key = f"{user}|{video['id']}"
+            if key not in docs and not self.entries.get(key):
+                docs[key] = self._entry(user, video)
+        if docs:
+            with self.entries.store.transaction():
+                self.entries.put_many(docs)
+                for doc in docs.values():
+                    self._trim(doc["user"])
+
+    def backfill(self, user, videos):
+        # a newly followed creator's recent videos
+        docs = {f"{user}|{video['id']}": self._entry(user, video) for video in videos if _published(video)}
+        if docs:
+            with self.entries.store.transaction():
+                self.entries.put_many(docs)
+                self._trim(user)
+
+    def unfollowed(self, user, uploader):
+        keys = [key for key, _ in self.entries.find(where={"user": user, "uploader": uploader})]
+        if keys:
+            self.entries.delete_many(keys)
+
+    def remove_video(self, video_id):
+        keys = [key for key, _ in self.entries.find(where={"video_id": video_id})]
+        if keys:
+            self.entries.delete_many(keys)
+
+    def remove_user(self, user):
+        keys = [key for key, _ in self.entries.find(where={"user": user})]
+        with self.entries.store.transaction():
+            if keys:
+                self.entries.delete_many(keys)
+            self.large.delete(user)
+
+    def rename(self, old, new):
+        rows = self.entries.find(where={"user": old})
+        with self.entries.store.transaction():
+            if rows:
+                self.entries.delete_many([key for key, _ in rows])
+                self.entries.put_many({f"{new}|{doc['video_id']}": dict(doc, user=new) for _, doc in rows})
+            large = self.large.get(old)
+            if large:
+                self.large.delete(old)
+                self.large.put(new, large)
+
+    def page(self, user, pulled=(), after=None, limit=24):
+        # video ids, user's timeline merged with the videos of the large
+        # creators in pulled, plus the after of the next page
+        rows = [(doc["uploaded_at"], doc["video_id"], True) for _, doc in self.entries.find(
+            where={"user": user}, order_by=("uploaded_at",), desc=True,
+            after=[after[0], f"{user}|{after[1]}"] if after else None, limit=limit + 1)]
+        for uploader in pulled:
+            rows += [(doc["uploaded_at"], key, _published(doc)) for key, doc in self.videos.find(
+                where={"uploader": uploader}, order_by=("uploaded_at",), desc=True, after=after, limit=limit + 1)]
+        # a creator's older uploads can be in both from before they got large.
+        # unpublished ones still count towards the page, so the cursor never
+        # skips past anything
+        rows = sorted(set(rows), reverse=True)
+        next_after = list(rows[limit - 1][:2]) if len(rows) > limit else None
+        return [video_id for _, video_id, published in rows[:limit] if published], next_after
+
+    def rebuild(self, follows, counts, per_creator=20):
+        # from scratch: follows is (follower, followee) pairs, counts(user) the
+        # user's follower count, each timeline gets the per_creator newest
+        # videos of everyone its user follows who isn't large
+        entries, large = {}, {}
+        latest = {}
+        for follower, followee in follows:
+            if followee in large:
+                continue
+            followers = counts(followee)
+            if followers >= self.large_at:
+                large[followee] = {"followers": followers}
+                continue
+            if followee not in latest:
+                latest[followee] = [doc for _, doc in self.videos.find(
+                    where={"uploader": followee}, order_by=("uploaded_at",), desc=True, limit=per_creator)
+                    if _published(doc)]
+            for video in latest[followee]:
+                entries[f"{follower}|{video['id']}"] = self._entry(follower, video)
+        self.entries.replace(entries)
+        self.large.replace(large)
+        for user in {doc["user"] for doc in entries.values()}:
+            self._trim(user)
@@ -0,0 +1,145 @@
+from datetime import datetime
+
+# ------------------------------
+# Follow graph
+# ------------------------------
+# One row per edge in the "follows" collection, keyed "<follower>|<followee>",
+# so following someone, unfollowing and "does a follow b" are single keyed
+# operations however many followers b has. Follower and following counts are
+# kept per user in "follow_counts" and moved along with every edge.
+#
+# Lists come newest first, after is the (since, key) of the last row on the
+# previous page.
+
+
+class FollowGraph:
+    def __init__(self, edges, counts):
+        self.edges = edges
+        self.counts = counts
+
+    def is_following(self, follower, followee):
+        if not follower:
+            return False
+        return self.edges.get(f"{follower}|{followee}") is not None
+
+    def following_among(self, follower, usernames):
+        # the ones in usernames follower follows, for a page of profile cards
+        if not follower:
+            return set()
+        rows = self.edges.find(where={"key": [f"{follower}|{u}" for u in usernames]})
+        return {doc["followee"] for _, doc in rows}
+
+    def count(self, username):
+        # (followers, following)
+        counts = self.counts.get(username)
+        return (counts["followers"], counts["following"]) if counts else (0, 0)
+
+    def _adjust(self, username, followers=0, following=0):
+        counts = self.counts.get(username) or {"followers": 0, "following": 0}
+        counts["followers"] = max(0, counts["followers"] + followers)
+        counts["following"] = max(0, counts["following"] + following)
+        if counts["followers"] or counts["following"]:
+            self.counts.put(username, counts)
+        else:
+            self.counts.delete(username)
+
+    def follow(self, follower, followee):
+        key = f"{follower}|{followee}"
+        with self.edges.store.transaction():
+            if self.edges.get(key):
+                return False
+            self.edges.put(key, {"follower": follower, "followee": followee, "since": datetime.utcnow().isoformat()})
+            self._adjust(followee, followers=1)
+            self._adjust(follower, following=1)
+        return True
+
+    def unfollow(self, follower, followee):
+        key = f"{follower}|{followee}"
+        with self.edges.store.transaction():
+            if not self.edges.get(key):
+                return False
+            self.edges.delete(key)
+            self._adjust(followee, followers=-1)
+            self._adjust(follower, following=-1)
+        return True
+
+    def toggle(self, follower, followee):
+        # returns whether follower follows followee afterwards
+        if self.unfollow(follower, followee):
+            return False
+        self.follow(follower, followee)
+        return True
+
+    def _page(self, column, username, other, after, limit):
+        rows, next_after = self.edges.find_page(where={column: username}, order_by=("since",), desc=True,
+                                                after=after, limit=limit)
+        return [doc[other] for _, doc in rows], next_after
+
+    def followers(self, username, after=None, limit=50):
+        # one page of usernames, plus the after of the next page
+        return self._page("followee", username, "follower", after, limit)
+
+    def following(self, username, after=None, limit=50):
+        return self._page("follower", username, "followee", after, limit)
+
+    def iter_followers(self, username, batch_size=500):
+        # every follower, batch_size usernames at a time
+        after = None
+        while True:
+            names, after = self.followers(username, after, batch_size)
+            if names:
+                yield names
+            if after is None:
+                return
+
+    def pairs(self):
+        # every (follower, followee)
+        return [(edge["follower"], edge["followee"]) for _, edge in self.edges.items()]
+
+    def remove_user(self, username):
+        # every edge to or from username, and the counts on the other ends
+        with self.edges.store.transaction():
+            for key, edge in self.edges.find(where={"followee": username}):
+                self.edges.delete(key)
+                self._adjust(edge["follower"], following=-1)
+            for key, edge in self.edges.find(where={"follower": username}):
+                self.edges.delete(key)
+                self._adjust(edge["followee"], followers=-1)
+            self.counts.delete(username)
+
+    def rename(self, old, new):
+        # username changed, their edges and counts move with them
+        with self.edges.store.transaction():
+            moved = {}
+            for key, edge in self.edges.find(where={"followee": old}):
+                moved[key] = dict(edge, followee=new)
+            for key, edge in self.edges.find(where={"follower": old}):
+                moved[key] = dict(moved.get(key, edge), follower=new)
+            if moved:
+                self.edges.delete_many(list(moved))
+                self.edges.put_many({f"{e['follower']}|{e['followee']}": e for e in moved.values()})
+            counts = self.counts.get(old)
+            if counts:
+                self.counts.delete(old)
+                self.counts.put(new, counts)
+
+    def import_lists(self, users):
+        # the followers/following lists older user records kept, either side
+        # of an edge is enough
+        since = datetime.utcnow().isoformat()
+        edges = {}
+        for username, user in users.items():
+            for follower in user.get("followers", []):
+                edges[f"{follower}|{username}"] = {"follower": follower, "followee": username, "since": since}
+            for followee in user.get("following", []):
+                edges[f"{username}|{followee}"] = {"follower": username, "followee": followee, "since": since}
+        if edges:
+            self.edges.put_many(edges)
+        self.recount()
+
+    def recount(self):
+        counts = {}
+        for _, edge in self.edges.find():
+            counts.setdefault(edge["followee"], {"followers": 0, "following": 0})["followers"] += 1
+            counts.setdefault(edge["follower"], {"followers": 0, "following": 0})["following"] += 1
+        self.counts.replace(counts)
@@ -0,0 +1,153 @@
+import os
+import socket
+import threading
+import time
+import uuid
+
+# ------------------------------
+# Background jobs
+# ------------------------------
+# A small durable job queue on top of a store collection. Jobs are claimed
+# inside a store transaction, so any number of threads and worker processes
+# can share one queue. A job whose worker died goes back to the queue: right
+# away if it ran on this machine, otherwise once its heartbeat is stale_after
+# seconds old.
+#
+# slots caps how many jobs run at once across every process sharing the
+# store, however many worker threads each of them has.
+#
+# Job states: queued -> running -> done (the job is then deleted)
+#                               -> queued again after a failure, until
+#                                  max_attempts is used up -> failed
+
+class JobQueue:
+    def __init__(self, collection, handler, on_failed=None, workers=1, slots=None, max_attempts=3,
+                 retry_delay=10, poll_interval=1.0, stale_after=600):
+        # handler(job, progress) does the work and calls progress(stage) as
+        # it goes, on_failed(job, error) runs once retries are used up
+        self.jobs = collection
+        self.handler = handler
+        self.on_failed = on_failed
+        self.workers = workers
+        self.slots = slots
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wake = threading.Event()
+        self._threads = []
+        self._last_stale_check = 0
+
+    def submit(self, payload, job_id=None):
+        now = time.time()
+        job = {
+            "id": job_id or str(uuid.uuid4()),
+            "status": "queued",
+            "stage": "queued",
+            "payload": payload,
+            "attempt": 0,
+            "max_attempts": self.max_attempts,
+            "error": None,
+            "created_at": now,
+            "run_after": now,
+            "heartbeat": None,
+            "worker": None,
+        }
+        self.jobs.put(job["id"], job)
+        self._wake.set()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def start(self):
+        if self._threads:
+            return
+        self._requeue(self._orphaned)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._wake.wait(self.poll_interval)
+                    self._wake.clear()
+                    continue
+                self._process(job)
+            except Exception as e:
+                # a busy store or a failing on_failed, the worker carries on.
+                # a job left running is requeued once its heartbeat goes stale
+                print("Job worker error:", e)
+                time.sleep(self.poll_interval)
+
+    def _claim(self):
+        now = time.time()
+        # look without locking first, idle polls shouldn't take the write lock
+        for key, queued in self.jobs.find(where={"status": "queued"}, order_by=("run_after",), limit=self.workers):
+            if queued["run_after"] > now:
+                break
+            with self.jobs.store.transaction():
+                if self.slots and self.jobs.count(where={"status": "running"}) >= self.slots:
+                    break  # every slot is taken, maybe by another process
+                job = self.jobs.get(key)
+                if not job or job["status"] != "queued":
+                    continue  # another worker got there first
+                job.update(status="running", attempt=job["attempt"] + 1, worker=self.worker_id, heartbeat=now)
+                self.jobs.put(key, job)
+            return job
+
+        if now - self._last_stale_check > self.stale_after / 10:
+            self._last_stale_check = now
+            self._requeue(lambda job: job["heartbeat"] < now - self.stale_after)
+        return None
+
+    def _orphaned(self, job):
+        # running on this machine under a process that no longer exists
+        host, _, pid = (job.get("worker") or "").rpartition(":")
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+
+    def _requeue(self, should_requeue):
+        for key, job in self.jobs.find(where={"status": "running"}):
+            if should_requeue(job):
+                print(f"Requeueing job {key} abandoned by {job.get('worker')}")
+                self._update(key, status="queued", stage="queued", run_after=time.time())
+
+    def _update(self, job_id, **fields):
+        with self.jobs.store.transaction():
+            job = self.jobs.get(job_id)
+            if job:
+                job.update(fields)
+                self.jobs.put(job_id, job)
+        return job
+
+    def _process(self, job):
+        def progress(stage):
+            self._update(job["id"], stage=stage, heartbeat=time.time())
+
+        try:
+            self.handler(job, progress)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            print(f"Job {job['id']} failed (attempt {job['attempt']}/{job['max_attempts']}):", error)
+            if job["attempt"] < job["max_attempts"]:
+                self._update(job["id"], status="queued", stage="retrying", error=error,
+                             run_after=time.time() + self.retry_delay * job["attempt"])
+            else:
+                self._update(job["id"], status="failed", stage="failed", error=error)
+                if self.on_failed:
+                    self.on_failed(job, error)
+        else:
+            self.jobs.delete(job["id"])
@@ -0,0 +1,132 @@
+import threading
+import time
+from datetime import datetime
+
+# ------------------------------
+# Creator leaderboard
+# ------------------------------
+# One entry per uploader in the "creators" collection with their upload
+# count, total likes and latest upload, kept up to date as videos come and go
+# and get voted on. Entries carry their popularity score
+#
+#     likes * 3 + uploads * 2 + 100 / days since the last upload
+#
+# and only creators with an upload in the last ACTIVE_DAYS days who aren't
+# shadowbanned are listed. The recency part changes once a day, so rescore()
+# runs every so often (see start()) instead of anyone scoring at read time.
+
+ACTIVE_DAYS = 60
+
+
+def _days_since(timestamp, now):
+    try:
+        return (now - datetime.fromisoformat(timestamp)).days
+    except (TypeError, ValueError):
+        return None
+
+
+def _score(entry, now):
+    days = _days_since(entry["last_upload"], now)
+    listed = days is not None and days <= ACTIVE_DAYS and entry["uploads"] > 0 and not entry["hidden"]
+    score = entry["likes"] * 3 + entry["uploads"] * 2 + (100 / max(days, 1) if days is not None else 0)
+    return dict(entry, score=round(score, 2), days_since_upload=days, listed=listed)
+
+
+class Leaderboard:
+    def __init__(self, collection):
+        self.creators = collection
+        self._thread = None
+
+    def _update(self, username, change):
+        # change(entry) edits the entry in place, it's rescored before saving
+        entry = self.creators.get(username) or {
+            "username": username,
+            "name_key": username.casefold(),
+            "uploads": 0,
+            "likes": 0,
+            "last_upload": None,
+            "hidden": False,
+        }
+        change(entry)
+        self.creators.put(username, _score(entry, datetime.utcnow()))
+
+    def video_added(self, username, uploaded_at, hidden=False):
+        def change(entry):
+            entry["uploads"] += 1
+            entry["hidden"] = hidden
+            entry["last_upload"] = max(entry["last_upload"] or uploaded_at, uploaded_at)
+        self._update(username, change)
+
+    def video_removed(self, username, likes, last_upload):
+        # last_upload: the newest of the videos username has left, or None
+        def change(entry):
+            entry["uploads"] = max(0, entry["uploads"] - 1)
+            entry["likes"] = max(0, entry["likes"] - likes)
+            entry["last_upload"] = last_upload
+        self._update(username, change)
+
+    def likes_changed(self, username, delta):
+        if delta:
+            self._update(username, lambda entry: entry.update(likes=max(0, entry["likes"] + delta)))
+
+    def set_hidden(self, username, hidden):
+        if self.creators.get(username):
+            self._update(username, lambda entry: entry.update(hidden=hidden))
+
+    def remove(self, username):
+        self.creators.delete(username)
+
+    def page(self, after=None, limit=48):
+        # listed creators, most popular first, plus the after of the next page
+        rows, next_after = self.creators.find_page(where={"listed": True}, order_by=("score",), desc=True,
+                                                   after=after, limit=limit)
+        return [doc for _, doc in rows], next_after
+
+    def search(self, text, limit=48):
+        # listed creators whose name starts with text, most popular first
+        rows = self.creators.find(where={"listed": True}, prefix=("name_key", text.casefold()))
+        return sorted((doc for _, doc in rows), key=lambda doc: doc["score"], reverse=True)[:limit]
+
+    def rescore(self):
+        now = datetime.utcnow()
+        stale = [key for key, entry in self.creators.items()
+                 if _score(entry, now) != entry]
+        if stale:
+            self.creators.update_many(stale, lambda key, entry: entry.update(_score(entry, now)))
+        return len(stale)
+
+    def rebuild(self, videos, hidden):
+        # from scratch, hidden(username) says whether they're shadowbanned
+        entries = {}
+        for video in videos:
+            username = video.get("uploader")
+            if not username:
+                continue
+            entry = entries.setdefault(username, {
+                "username": username,
+                "name_key": username.casefold(),
+                "uploads": 0,
+                "likes": 0,
+                "last_upload": None,
+                "hidden": hidden(username),
+            })
+            entry["uploads"] += 1
+            entry["likes"] += video.get("likes", 0)
+            uploaded_at = video.get("uploaded_at")
+            if uploaded_at and (entry["last_upload"] is None or uploaded_at > entry["last_upload"]):
+                entry["last_upload"] = uploaded_at
+        now = datetime.utcnow()
+        self.creators.replace({username: _score(entry, now) for username, entry in entries.items()})
+
+    def start(self, interval):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.rescore()
+            except Exception as e:
+                print("Leaderboard rescore failed:", e)
@@ -0,0 +1,174 @@
+import os
+import hashlib
+import subprocess
+import time
+import ffmpeg
+
+# ------------------------------
+# Media processing
+# ------------------------------
+# ffmpeg steps run by the transcode jobs, never inside a request.
+
+THUMB_WIDTH = 320
+HLS_SEGMENT_SECONDS = 2
+HLS_PLAYLIST = "index.m3u8"
+
+
+class EncodeTimeout(Exception):
+    pass
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+def save_hashed(stream, path):
+    # writes stream to path, returns the content hash of what was written
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        for block in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(block)
+            f.write(block)
+    return digest.hexdigest()[:32]
+
+
+def _run(stream, timeout):
+    # run an ffmpeg graph, killing it once it goes over timeout seconds
+    process = stream.overwrite_output().run_async(pipe_stdout=True, pipe_stderr=True)
+    try:
+        _, err = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise EncodeTimeout(f"encode took longer than {timeout}s")
+    if process.returncode:
+        raise ffmpeg.Error("ffmpeg", None, err)
+
+
+def transcode(src_path, dst_path, thumb_path=None, extra_outputs=(), has_audio=True, duration=None,
+              preset="veryfast", crf=23, timeout=None):
+    # One decode of src_path feeds every output: the square H.264 mp4 at
+    # dst_path, the first frame as a thumbnail at thumb_path, and any
+    # extra_outputs, each a function (video, audio) -> ffmpeg output.
+    # Without audio a silent track is added, cut to duration (the probed
+    # length) so every output ends with the video. Returns the encode time
+    # in seconds.
+    outputs = (1 if thumb_path else 0) + len(extra_outputs)
+    square_path = dst_path.rsplit(".", 1)[0] + "_square.mp4"
+
+    # Crop to square and preserve audio (or add silent audio if missing)
+    input_stream = ffmpeg.input(src_path)
+    video_stream = input_stream.video.filter(
+        'crop', 'min(iw,ih)', 'min(iw,ih)', '(ow-iw)/-2', '(oh-ih)/-2'
+    )
+    if has_audio:
+        audio_stream = input_stream.audio
+    else:
+        silence = {"t": duration} if duration else {}
+        audio_stream = ffmpeg.input('anullsrc=cl=stereo:r=44100', f='lavfi', **silence).audio
+
+    videos = video_stream.split() if outputs else None
+    audios = audio_stream.asplit() if extra_outputs else None
+
+    streams = [ffmpeg.output(
+        videos[0] if outputs else video_stream, audios[0] if audios else audio_stream, square_path,
+        vcodec='libx264', preset=preset, crf=crf, pix_fmt='yuv420p',
+        acodec='aac', audio_bitrate='128k', movflags='+faststart', shortest=None
+    )]
+    branch = 1
+    if thumb_path:
+        streams.append(ffmpeg.output(videos[branch].filter('scale', THUMB_WIDTH, -2), thumb_path, vframes=1))
+        branch += 1
+    for i, make_output in enumerate(extra_outputs):
+        streams.append(make_output(videos[branch + i], audios[i + 1]))
+
+    started = time.monotonic()
+    try:
+        _run(ffmpeg.merge_outputs(*streams), timeout)
+    except Exception:
+        if os.path.exists(square_path):
+            os.remove(square_path)
+        raise
+    os.replace(square_path, dst_path)
+    return time.monotonic() - started
+
+
+# ---- HLS ----
+# Each rendition is a folder with an index.m3u8 and its .ts segments, the
+# master playlist next to them lists the folders lowest bitrate first.
+
+def _hls_options(out_dir):
+    return dict(
+        f='hls', hls_time=HLS_SEGMENT_SECONDS, hls_playlist_type='vod',
+        hls_segment_filename=os.path.join(out_dir, 'seg_%03d.ts')
+    )
+
+
+def hls_output(video, audio, out_dir, size, kbps, preset="veryfast"):
+    # a size x size rendition for transcode()'s extra_outputs, keyframes are
+    # forced on segment boundaries so players can switch between renditions
+    os.makedirs(out_dir, exist_ok=True)
+    return ffmpeg.output(
+        video.filter('scale', size, size), audio, os.path.join(out_dir, HLS_PLAYLIST),
+        vcodec='libx264', preset=preset, pix_fmt='yuv420p',
+        video_bitrate=f"{kbps}k", maxrate=f"{kbps}k", bufsize=f"{kbps * 2}k",
+        force_key_frames=f"expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})",
+        acodec='aac', audio_bitrate='96k', shortest=None,
+        **_hls_options(out_dir)
+    )
+
+
+def package_hls(mp4_path, out_dir):
+    # an already encoded mp4 as an HLS rendition, stream copy, no re-encode
+    os.makedirs(out_dir, exist_ok=True)
+    (
+        ffmpeg
+        .input(mp4_path)
+        .output(os.path.join(out_dir, HLS_PLAYLIST), c='copy', **_hls_options(out_dir))
+        .overwrite_output()
+        .run(quiet=True)
+    )
+
+
+def peak_bandwidth(out_dir):
+    # bits per second of the heaviest segment, what BANDWIDTH should advertise
+    peak = 0
+    duration = None
+    with open(os.path.join(out_dir, HLS_PLAYLIST)) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXTINF:"):
+                duration = float(line[8:].split(",")[0])
+            elif line and not line.startswith("#") and duration:
+                size = os.path.getsize(os.path.join(out_dir, line))
+                peak = max(peak, int(size * 8 / duration))
+    return peak
+
+
+def write_master_playlist(path, renditions):
+    # renditions: dicts with playlist (relative to path), bandwidth, width, height
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for rendition in sorted(renditions, key=lambda r: r["bandwidth"]):
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={rendition['bandwidth']},"
+                     f"RESOLUTION={rendition['width']}x{rendition['height']}")
+        lines.append(rendition["playlist"])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def make_thumbnail(video_path, thumb_path):
+    # only for files that didn't go through transcode(), e.g. raw fallbacks
+    (
+        ffmpeg
+        .input(video_path, ss=0)
+        .filter('scale', THUMB_WIDTH, -1)
+        .output(thumb_path, vframes=1)
+        .overwrite_output()
+        .run(quiet=True)
+    )
@@ -0,0 +1,146 @@
+import uuid
+from datetime import datetime, timedelta
+
+# ------------------------------
+# Notifications
+# ------------------------------
+# Every notification is its own document in the "notifications" collection,
+# keyed "<user>|<event id>", so sending the same event to someone twice (a
+# retried fan-out batch) only writes it once. Inboxes keep the newest
+# inbox_limit notifications, and prune() drops anything older than
+# retention_days.
+#
+# An event is {"id", "type", "from_user", "video_id", "video_title"}, the id
+# is optional for events that only ever go to one user.
+#
+# Unread counts are kept per user in a second collection and moved along with
+# every write here, so the badge on each page is one keyed read. repair()
+# recounts them from the notifications themselves.
+
+
+class NotificationStore:
+    def __init__(self, collection, counts, inbox_limit=500, retention_days=90):
+        self.notifications = collection
+        self.counts = counts
+        self.inbox_limit = inbox_limit
+        self.retention_days = retention_days
+
+    def _adjust(self, deltas):
+        # deltas: {user: change in unread count}
+        for user, delta in deltas.items():
+            if not delta:
+                continue
+            count = self.counts.get(user)
+            unread = max(0, (count["unread"] if count else 0) + delta)
+            if unread:
+                self.counts.put(user, {"unread": unread})
+            elif count:
+                self.counts.delete(user)
+
+    def _remove(self, rows):
+        # delete (key, doc) rows, keeping the unread counts right
+        deltas = {}
+        for _, doc in rows:
+            if not doc["read"]:
+                deltas[doc["user"]] = deltas.get(doc["user"], 0) - 1
+        self.notifications.delete_many([key for key, _ in rows])
+        self._adjust(deltas)
+
+    def add(self, user, event):
+        return self.add_many([user], event)
+
+    def add_many(self, users, event):
+        # event for each of users, returns the users it was new for
+        event_id = event.get("id") or str(uuid.uuid4())
+        timestamp = datetime.utcnow().isoformat()
+        docs = {}
+        for user in users:
+            key = f"{user}|{event_id}"
+            if key in docs or self.notifications.get(key):
+                continue
+            docs[key] = dict(event, id=event_id, user=user, timestamp=timestamp, read=False)
+        if docs:
+            with self.notifications.store.transaction():
+                self.notifications.put_many(docs)
+                self._adjust({doc["user"]: 1 for doc in docs.values()})
+                for doc in docs.values():
+                    self._trim(doc["user"])
+        return [doc["user"] for doc in docs.values()]
+
+    def _trim(self, user):
+        over = self.notifications.count(where={"user": user}) - self.inbox_limit
+        if over > 0:
+            self._remove(self.notifications.find(where={"user": user}, order_by=("timestamp",), limit=over))
+
+    def page(self, user, after=None, limit=50):
+        # newest first, plus the after of the next page
+        rows, next_after = self.notifications.find_page(where={"user": user}, order_by=("timestamp",), desc=True,
+                                                        after=after, limit=limit)
+        return [doc for _, doc in rows], next_after
+
+    def unread_count(self, user):
+        count = self.counts.get(user)
+        return count["unread"] if count else 0
+
+    def mark_read(self, user, ids=None):
+        # ids None marks the whole inbox, returns how many were unread
+        if ids is None:
+            keys = [key for key, _ in self.notifications.find(where={"user": user, "read": False})]
+        else:
+            keys = [f"{user}|{i}" for i in ids]
+        marked = []
+
+        def mark(key, doc):
+            if not doc["read"]:
+                doc["read"] = True
+                marked.append(key)
+
+        if keys:
+            with self.notifications.store.transaction():
+                self.notifications.update_many(keys, mark)
+                self._adjust({user: -len(marked)})
+        return len(marked)
+
+    def remove_user(self, user):
+        # user's inbox and everything they sent to others
+        rows = dict(self.notifications.find(where={"user": user}))
+        rows.update(self.notifications.find(where={"from_user": user}))
+        with self.notifications.store.transaction():
+            if rows:
+                self._remove(list(rows.items()))
+            self.counts.delete(user)
+
+    def prune(self, batch_size=500):
+        cutoff = (datetime.utcnow() - timedelta(days=self.retention_days)).isoformat()
+        removed = 0
+        while True:
+            oldest = self.notifications.find(order_by=("timestamp",), limit=batch_size)
+            stale = [(key, doc) for key, doc in oldest if doc["timestamp"] < cutoff]
+            if stale:
+                with self.notifications.store.transaction():
+                    self._remove(stale)
+                removed += len(stale)
+            if len(stale) < batch_size:
+                return removed
+
+    def import_inbox(self, user, notifications):
+        # the notifications list older user records kept
+        docs = {}
+        for n in notifications:
+            event_id = n.get("id") or str(uuid.uuid4())
+            docs[f"{user}|{event_id}"] = dict(n, id=event_id, user=user, read=bool(n.get("read")),
+                                              timestamp=n.get("timestamp") or datetime.utcnow().isoformat())
+        if docs:
+            self.notifications.put_many(docs)
+            self._adjust({user: sum(1 for doc in docs.values() if not doc["read"])})
+            self._trim(user)
+
+    def repair(self):
+        # recount every inbox, returns the users whose count was off
+        actual = {}
+        for _, doc in self.notifications.find(where={"read": False}):
+            actual[doc["user"]] = actual.get(doc["user"], 0) + 1
+        stored = {user: count["unread"] for user, count in self.counts.items()}
+        if actual != stored:
+            self.counts.replace({user: {"unread": unread} for user, unread in actual.items()})
+        return sorted(user for user in actual.keys() | stored.keys() if actual.get(user) != stored.get(user))
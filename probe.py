@@ -0,0 +1,167 @@
+import os
+import struct
+import ffmpeg
+
+# ------------------------------
+# Media probe
+# ------------------------------
+# Reads duration and stream layout from container metadata, nothing gets
+# decoded. MP4/MOV headers are parsed right here (no subprocess), anything
+# else goes through ffprobe.
+#
+# probe_video() returns {"format", "duration", "width", "height",
+# "video_codec", "audio_codec"}, missing values are None.
+
+MAX_MOOV_BYTES = 16 * 1024 * 1024  # a moov box bigger than this isn't a short clip
+
+
+class ProbeError(Exception):
+    pass
+
+
+def probe_video(path):
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[4:8] == b"ftyp":
+        try:
+            return _probe_mp4(path)
+        except (ProbeError, struct.error, UnicodeDecodeError):
+            pass  # unusual layout, let ffprobe have a go
+    return _probe_ffprobe(path)
+
+
+def probe_partial(path):
+    # probe_video() for an upload that's still arriving: None until enough
+    # of the file is there to tell (only MP4/MOV can be read early)
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head[4:8] != b"ftyp":
+        return None
+    try:
+        return _probe_mp4(path)
+    except (ProbeError, struct.error, UnicodeDecodeError):
+        return None
+
+
+# ---- MP4 / MOV (ISO base media) ----
+
+def _boxes(data, start, end):
+    # (type, payload start, payload end) of each box in data[start:end]
+    while start + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[start:start + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[start + 8:start + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            raise ProbeError("corrupt mp4 box")
+        yield kind, start + header, min(start + size, end)
+        start += size
+
+
+def _find(data, start, end, *path):
+    for kind, s, e in _boxes(data, start, end):
+        if kind == path[0]:
+            return (s, e) if len(path) == 1 else _find(data, s, e, *path[1:])
+    return None
+
+
+def _read_moov(f, file_size):
+    # walk the top level boxes with seeks, the moov can sit after the media data
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        size, kind = struct.unpack(">I4s", f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header:
+            raise ProbeError("corrupt mp4 box")
+        if kind == b"moov":
+            if size > MAX_MOOV_BYTES:
+                raise ProbeError("mp4 header too large")
+            if pos + size > file_size:
+                raise ProbeError("mp4 header incomplete")
+            return f.read(size - header)
+        pos += size
+    raise ProbeError("no moov box")
+
+
+def _duration(data, start):
+    # mvhd and mdhd start the same way: version, flags, times, timescale, duration
+    if data[start] == 1:
+        timescale, duration = struct.unpack(">IQ", data[start + 20:start + 32])
+    else:
+        timescale, duration = struct.unpack(">II", data[start + 12:start + 20])
+    return duration / timescale if timescale else None
+
+
+def _probe_mp4(path):
+    with open(path, "rb") as f:
+        moov = _read_moov(f, os.fstat(f.fileno()).st_size)
+
+    info = {"format": "mp4", "duration": None, "width": None, "height": None,
+            "video_codec": None, "audio_codec": None}
+    track_durations = []
+    for kind, start, end in _boxes(moov, 0, len(moov)):
+        if kind == b"mvhd":
+            info["duration"] = _duration(moov, start)
+        elif kind == b"trak":
+            hdlr = _find(moov, start, end, b"mdia", b"hdlr")
+            stsd = _find(moov, start, end, b"mdia", b"minf", b"stbl", b"stsd")
+            if not hdlr or not stsd:
+                continue
+            handler = moov[hdlr[0] + 8:hdlr[0] + 12]
+            # stsd: version/flags, entry count, then the first entry's size and format
+            codec = moov[stsd[0] + 12:stsd[0] + 16].decode("ascii").strip() or None
+            mdhd = _find(moov, start, end, b"mdia", b"mdhd")
+            if mdhd:
+                track_durations.append(_duration(moov, mdhd[0]))
+            if handler == b"vide" and not info["video_codec"]:
+                info["video_codec"] = codec
+                tkhd = _find(moov, start, end, b"tkhd")
+                if tkhd:
+                    # display size, 16.16 fixed point at the end of tkhd
+                    width, height = struct.unpack(">II", moov[tkhd[1] - 8:tkhd[1]])
+                    info["width"], info["height"] = width >> 16, height >> 16
+            elif handler == b"soun" and not info["audio_codec"]:
+                info["audio_codec"] = codec
+
+    if not info["duration"]:
+        info["duration"] = max((d for d in track_durations if d), default=None)
+    return info
+
+
+# ---- everything else ----
+
+def _probe_ffprobe(path):
+    try:
+        data = ffmpeg.probe(path)
+    except ffmpeg.Error as e:
+        raise ProbeError("not a readable video") from e
+    except OSError as e:
+        raise ProbeError("ffprobe is not available") from e
+
+    fmt = data.get("format", {})
+    info = {"format": fmt.get("format_name"), "duration": None, "width": None, "height": None,
+            "video_codec": None, "audio_codec": None}
+    durations = [fmt.get("duration")]
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and not info["video_codec"]:
+            info["video_codec"] = stream.get("codec_name")
+            info["width"], info["height"] = stream.get("width"), stream.get("height")
+        elif stream.get("codec_type") == "audio" and not info["audio_codec"]:
+            info["audio_codec"] = stream.get("codec_name")
+        durations.append(stream.get("duration"))
+    for duration in durations:
+        try:
+            info["duration"] = float(duration)
+            break
+        except (TypeError, ValueError):
+            continue
+    return info
@@ -0,0 +1,245 @@
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+# ------------------------------
+# Storage reconciler
+# ------------------------------
+# Compares what is on disk in the media folders with what the store points
+# at, and cleans up the difference:
+#   - files and HLS folders nothing references, temp files no job or upload
+#     session needs (only once they're older than grace seconds, so work in
+#     flight is left alone)
+#   - chunked upload sessions idle for longer than upload_ttl
+#   - media entries no video uses any more, failed jobs older than job_ttl
+#   - references to things that are gone: deleted videos on media entries,
+#     missing media entries and thumbnails on videos
+# Videos whose mp4 is missing are only reported.
+#
+# The records and folders are scanned without holding the store lock. Fixes
+# and deletes then go batch_size at a time with batch_pause seconds in between,
+# records in one short transaction per batch, and every batch re-checks what
+# it's about to change first. dry_run only reports.
+
+class Reconciler:
+    def __init__(self, store, media_files, upload_sessions, jobs, folders, temp_folder,
+                 grace=3600, upload_ttl=24 * 3600, job_ttl=7 * 24 * 3600, batch_size=200, batch_pause=0.5):
+        # folders: {"videos": path, "thumbnails": path, "hls": path}
+        self.store = store
+        self.media_files = media_files
+        self.upload_sessions = upload_sessions
+        self.jobs = jobs
+        self.folders = folders
+        self.temp_folder = temp_folder
+        self.grace = grace
+        self.upload_ttl = upload_ttl
+        self.job_ttl = job_ttl
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self._thread = None
+
+    def _references(self):
+        # file names in use per folder, plus the temp folder under "temp"
+        refs = {kind: set() for kind in self.folders}
+        refs["temp"] = set()
+        for doc in list(self.store.videos.values()) + list(self.media_files.values()):
+            refs["videos"].add(doc.get("video"))
+            refs["thumbnails"].add(doc.get("thumbnail"))
+            if doc.get("hls"):
+                refs["hls"].add(os.path.dirname(doc["hls"]))
+        for key, job in self.jobs.items():
+            if job["status"] in ("queued", "running"):
+                # the upload and the job's working files
+                refs["temp"].add(os.path.basename(job["payload"]["temp_path"]))
+                raw = f"{key}.work{os.path.splitext(job['payload']['temp_path'])[1].lower()}"
+                refs["videos"].update((f"{key}.work.mp4", f"{key}.work_square.mp4", raw))
+                refs["thumbnails"].add(f"{key}.work.png")
+                refs["hls"].add(key)
+        for upload_id in self.upload_sessions.snapshot().docs:
+            refs["temp"].update((f"{upload_id}.part", f"{upload_id}.part.lock"))
+        return refs
+
+    def _scan(self, kind, folder, refs, now):
+        # (kind, path, bytes) for everything in folder that nothing references
+        orphans = []
+        if not os.path.isdir(folder):
+            return orphans
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or entry.name in refs[kind]:
+                    continue
+                if now - entry.stat().st_mtime < self.grace:
+                    continue
+                if entry.is_dir():
+                    size = sum(os.path.getsize(os.path.join(root, name))
+                               for root, _, names in os.walk(entry.path) for name in names)
+                else:
+                    size = entry.stat().st_size
+                orphans.append((kind, entry.path, size))
+        return orphans
+
+    def _expired(self, upload_session, cutoff):
+        return upload_session["updated_at"] < cutoff
+
+    def _old_job(self, job, now):
+        return job["status"] == "failed" and now - (job.get("heartbeat") or job["created_at"]) > self.job_ttl
+
+    def _video_fixes(self, video, has_media):
+        fixes = {}
+        if "media" in video:
+            media = [h for h in video["media"] if has_media(h)]
+            if len(media) != len(video["media"]):
+                fixes["media"] = media
+        thumbnail = video.get("thumbnail")
+        if thumbnail and not os.path.exists(os.path.join(self.folders["thumbnails"], thumbnail)):
+            fixes["thumbnail"] = None
+        return fixes
+
+    def _in_batches(self, keys, apply):
+        # apply(key) for each key, batch_size of them per transaction
+        for start in range(0, len(keys), self.batch_size):
+            if start:
+                time.sleep(self.batch_pause)
+            with self.store.transaction():
+                for key in keys[start:start + self.batch_size]:
+                    apply(key)
+
+    def run(self, dry_run=False):
+        now = time.time()
+        report = {
+            "orphans": [],
+            "bytes": 0,
+            "expired_uploads": [],
+            "unused_media": [],
+            "old_jobs": [],
+            "fixed_videos": [],
+            "missing_files": [],
+        }
+
+        # records first: whatever they stop referencing is picked up by the
+        # file scan below
+        video_ids = set(self.store.videos.snapshot().docs)
+        cutoff = (datetime.utcnow() - timedelta(seconds=self.upload_ttl)).isoformat()
+        for upload_id, upload_session in self.upload_sessions.items():
+            if self._expired(upload_session, cutoff):
+                report["expired_uploads"].append(upload_id)
+
+        trimmed_media = []
+        for media_hash, entry in self.media_files.items():
+            users = [v for v in entry["videos"] if v in video_ids]
+            if not users and entry["status"] != "processing":
+                report["unused_media"].append(media_hash)
+            elif len(users) != len(entry["videos"]):
+                trimmed_media.append(media_hash)
+
+        for key, job in self.jobs.items():
+            if self._old_job(job, now):
+                report["old_jobs"].append(key)
+
+        entries = self.media_files.snapshot().docs
+        unused = set(report["unused_media"])
+        for video in self.store.videos.values():
+            if self._video_fixes(video, lambda h: h in entries and h not in unused):
+                report["fixed_videos"].append(video["id"])
+            if video.get("video") and not os.path.exists(os.path.join(self.folders["videos"], video["video"])):
+                report["missing_files"].append(video["id"])
+
+        if not dry_run:
+            # each record as it is now, it may have changed since the scan
+            def trim_media(media_hash):
+                entry = self.media_files.get(media_hash)
+                if entry:
+                    users = [v for v in entry["videos"] if self.store.videos.get(v) is not None]
+                    if len(users) != len(entry["videos"]):
+                        self.media_files.put(media_hash, dict(entry, videos=users))
+
+            def drop_media(media_hash):
+                entry = self.media_files.get(media_hash)
+                if entry and entry["status"] != "processing" and not any(
+                        self.store.videos.get(v) is not None for v in entry["videos"]):
+                    self.media_files.delete(media_hash)
+
+            def drop_upload(upload_id):
+                upload_session = self.upload_sessions.get(upload_id)
+                if upload_session and self._expired(upload_session, cutoff):
+                    self.upload_sessions.delete(upload_id)
+
+            def drop_job(key):
+                job = self.jobs.get(key)
+                if job and self._old_job(job, now):
+                    self.jobs.delete(key)
+
+            def fix_video(video_id):
+                video = self.store.videos.get(video_id)
+                fixes = self._video_fixes(video, lambda h: self.media_files.get(h) is not None) if video else None
+                if fixes:
+                    self.store.videos.put(video_id, dict(video, **fixes))
+
+            self._in_batches(trimmed_media, trim_media)
+            self._in_batches(report["unused_media"], drop_media)
+            self._in_batches(report["expired_uploads"], drop_upload)
+            self._in_batches(report["old_jobs"], drop_job)
+            self._in_batches(report["fixed_videos"], fix_video)
+
+        refs = self._references()
+        if dry_run:
+            # pretend the records above are gone already
+            for media_hash in report["unused_media"]:
+                entry = self.media_files.get(media_hash)
+                refs["videos"].discard(entry.get("video"))
+                refs["thumbnails"].discard(entry.get("thumbnail"))
+                refs["hls"].discard(media_hash)
+            for upload_id in report["expired_uploads"]:
+                refs["temp"].difference_update((f"{upload_id}.part", f"{upload_id}.part.lock"))
+        for kind, folder in list(self.folders.items()) + [("temp", self.temp_folder)]:
+            report["orphans"].extend(self._scan(kind, folder, refs, now))
+        report["bytes"] = sum(size for _, _, size in report["orphans"])
+
+        if not dry_run:
+            self._delete(report["orphans"])
+        return report
+
+    def _delete(self, orphans):
+        for start in range(0, len(orphans), self.batch_size):
+            if start:
+                time.sleep(self.batch_pause)
+            refs = self._references()  # something may have picked a file up since the scan
+            for kind, path, _ in orphans[start:start + self.batch_size]:
+                if os.path.basename(path) in refs[kind]:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+
+    def start(self, interval):
+        # every interval seconds, in whichever worker process gets there first
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def _due(self, interval):
+        with self.store.transaction():
+            last = self.store.get_meta("reconciled_at")
+            now = datetime.utcnow()
+            if last and now - datetime.fromisoformat(last) < timedelta(seconds=interval):
+                return False
+            self.store.set_meta("reconciled_at", now.isoformat())
+            return True
+
+    def _run(self, interval):
+        while True:
+            # wait first, a process that just started (or a CLI command) has
+            # better things to do
+            time.sleep(min(interval, 600))
+            try:
+                if self._due(interval):
+                    report = self.run()
+                    if report["orphans"] or report["unused_media"] or report["expired_uploads"]:
+                        print(f"Storage reconciler freed {report['bytes']} bytes in {len(report['orphans'])} files, "
+                              f"dropped {len(report['unused_media'])} media entries "
+                              f"and {len(report['expired_uploads'])} stale uploads")
+            except Exception as e:
+                print("Storage reconcile failed:", e)
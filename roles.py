@@ -0,0 +1,32 @@
+# ------------------------------
+# Roles
+# ------------------------------
+# Who is an admin or moderator, answered from memory. The registry is rebuilt
+# whenever the "roles" collection's snapshot changes (a save_admins(), or
+# admins.json edited on disk with the json backend), so a lookup is a set
+# membership test however long the lists grow.
+
+
+class RoleRegistry:
+    def __init__(self, collection):
+        self.roles = collection
+        self._cache = (None, {})  # (snapshot, {username: frozenset of roles})
+
+    def _by_user(self):
+        snap, by_user = self._cache
+        current = self.roles.snapshot()
+        if current is not snap:
+            grouped = {}
+            for doc in current.values:
+                grouped.setdefault(doc["username"], set()).add(doc["role"])
+            by_user = {username: frozenset(roles) for username, roles in grouped.items()}
+            self._cache = (current, by_user)
+        return by_user
+
+    def roles_of(self, username):
+        if not username:
+            return frozenset()
+        return self._by_user().get(username, frozenset())
+
+    def members(self, role):
+        return sorted(username for username, roles in self._by_user().items() if role in roles)
@@ -0,0 +1,77 @@
+import re
+from collections import Counter
+
+# ------------------------------
+# Video search
+# ------------------------------
+# Inverted index kept in the "search_terms" collection: one row per
+# (term, video) with a weight, so a query only reads the rows for its own
+# terms instead of scanning every video. Videos from shadowbanned uploaders
+# are simply left out of the index.
+
+FIELD_WEIGHTS = {"title": 3, "uploader": 2, "description": 1}
+PREFIX_MATCH = 0.5  # "brr" finding "brrr" counts half as much as an exact hit
+MAX_TERM_ROWS = 5000  # cap on rows read per query word, keeps short prefixes cheap
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or "").lower())
+
+
+class SearchIndex:
+    def __init__(self, collection):
+        self.terms = collection
+
+    def _rows(self, video):
+        weights = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(video.get(field)):
+                weights[term] += weight
+        return {
+            f"{term}|{video['id']}": {"term": term, "video_id": video["id"], "weight": weight}
+            for term, weight in weights.items()
+        }
+
+    def index_video(self, video, hidden=False):
+        # (re)index one video, hidden=True drops it from results
+        with self.terms.store.transaction():
+            self.remove_video(video["id"])
+            if not hidden:
+                self.terms.put_many(self._rows(video))
+
+    def remove_video(self, video_id):
+        keys = [key for key, _ in self.terms.find(where={"video_id": video_id})]
+        if keys:
+            self.terms.delete_many(keys)
+
+    def search(self, query, limit=None):
+        # ids of the videos matching every word of the query, each word also
+        # matches longer terms starting with it. Best match first.
+        words = tokenize(query)
+        if not words:
+            return []
+
+        scores = None
+        for word in dict.fromkeys(words):
+            matches = {}
+            for _, row in self.terms.find(prefix=("term", word), order_by=("term",), limit=MAX_TERM_ROWS):
+                weight = row["weight"] * (1 if row["term"] == word else PREFIX_MATCH)
+                matches[row["video_id"]] = max(matches.get(row["video_id"], 0), weight)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {v: scores[v] + w for v, w in matches.items() if v in scores}
+            if not scores:
+                return []
+
+        ranked = sorted(scores, key=lambda v: scores[v], reverse=True)
+        return ranked[:limit] if limit else ranked
+
+    def rebuild(self, videos, is_hidden):
+        rows = {}
+        for video in videos:
+            if not is_hidden(video):
+                rows.update(self._rows(video))
+        self.terms.replace(rows)
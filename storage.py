@@ -0,0 +1,631 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # windows, locks only cover threads of this process
+    fcntl = None
+
+# ------------------------------
+# Collections
+# ------------------------------
+# Every entity lives in a "collection": a mapping of key -> JSON document.
+# The sqlite backend stores one row per document (plus a few copied-out
+# columns so they can be indexed), the json backend keeps the old flat files.
+
+# copied-out columns per collection, these are the fields find() can filter
+# and sort on
+COLUMNS = {
+    "videos": ("uploader", "uploaded_at", "views", "likes"),
+    "users": (),
+    "roles": ("role", "username"),
+    "search_terms": ("term", "video_id"),
+    "jobs": ("status", "run_after"),
+    "votes": ("target", "user", "scope"),
+    "comments": ("video_id", "parent_id", "timestamp"),
+    "notifications": ("user", "from_user", "timestamp", "read"),
+    "notify_jobs": ("status", "run_after"),
+    "creators": ("name_key", "score", "listed"),
+    "user_names": ("name_key",),
+    "user_hints": ("hint_key", "username"),
+    "follows": ("follower", "followee", "since"),
+    "timelines": ("user", "video_id", "uploader", "uploaded_at"),
+}
+
+# sqlite indexes per collection
+INDEXES = {
+    # the home page sort orders, each ends with key for keyset pagination
+    "videos": (("uploader", "uploaded_at"), ("uploaded_at", "key"), ("views", "key"), ("likes", "key")),
+    "users": (),
+    "roles": (("role", "username"),),
+    "search_terms": (("term", "key"), ("video_id",)),
+    # workers poll for the oldest runnable job
+    "jobs": (("status", "run_after", "key"),),
+    # a viewer's votes on one video page, and everything to drop with a video
+    "votes": (("user", "scope"), ("scope",), ("target",)),
+    # one page of a video's top level comments or of a comment's replies
+    "comments": (("video_id", "parent_id", "timestamp", "key"),),
+    # an inbox newest first, its unread ones, what a user sent, and the
+    # oldest overall for the retention sweep
+    "notifications": (("user", "timestamp", "key"), ("user", "read"), ("from_user",), ("timestamp", "key")),
+    "notify_jobs": (("status", "run_after", "key"),),
+    # the /profiles ranking and its username search
+    "creators": (("listed", "score", "key"), ("listed", "name_key")),
+    # case-insensitive profile links and username recovery
+    "user_names": (("name_key",),),
+    "user_hints": (("hint_key",), ("username",)),
+    # follower and following lists, newest first
+    "follows": (("followee", "since", "key"), ("follower", "since", "key")),
+    # following feeds, newest first, and what to drop on unfollow or delete
+    "timelines": (("user", "uploaded_at", "key"), ("user", "uploader"), ("video_id",)),
+}
+
+# find() arguments, shared by both backends:
+#   where     {column: value} equality filters, a list or tuple value
+#             matches any of its items
+#   prefix    (column, text) for "column starts with text"
+#   order_by  columns to sort on, the key is always added as a tie-breaker
+#   after     sort values (ending with the key) of the last row already seen,
+#             for keyset pagination
+# Results are (key, doc) pairs with read-only docs.
+
+
+def _dump(obj, f):
+    json.dump(obj, f, indent=2, ensure_ascii=False)
+
+
+def atomic_write_json(path, obj):
+    # write a temp file next to the target, fsync it and rename it over the
+    # target so readers only ever see the old or the new file, never half of one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            _dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class FileLock:
+    # exclusive lock on a side file, shared by every worker process and
+    # re-entrant within a thread
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        depth = getattr(self._local, "depth", 0)
+        if depth == 0 and fcntl:
+            self._local.file = open(self.path, "a")
+            fcntl.flock(self._local.file, fcntl.LOCK_EX)
+        self._local.depth = depth + 1
+        return self
+
+    def __exit__(self, *exc):
+        self._local.depth -= 1
+        if self._local.depth == 0 and fcntl:
+            fcntl.flock(self._local.file, fcntl.LOCK_UN)
+            self._local.file.close()
+            self._local.file = None
+        self._thread_lock.release()
+
+
+# ------------------------------
+# Read cache
+# ------------------------------
+# Whole-collection reads (load_videos, load_users...) are served from a parsed
+# snapshot kept in memory. The snapshot is shared by every request, so it is
+# handed out read-only; use get() or thaw() when you need something to change.
+
+class FrozenDict(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("cached documents are read-only, use thaw() to get a copy")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    update = setdefault = pop = popitem = clear = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(obj):
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    if isinstance(obj, dict):
+        return {k: thaw(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [thaw(v) for v in obj]
+    return obj
+
+
+class Snapshot:
+    def __init__(self, generation, docs):
+        self.generation = generation
+        self.docs = FrozenDict((key, freeze(doc)) for key, doc in docs)
+        self.values = tuple(self.docs.values())
+        self.sorted = {}  # sort order -> (rows, sort keys), built on first use
+
+
+class CachedCollection:
+    # subclasses provide generation() and _load_all()
+    _snapshot = None
+
+    def snapshot(self):
+        # read the generation before loading so a write that lands in between
+        # leaves us with an older generation and the next call reloads
+        generation = self.generation()
+        snap = self._snapshot
+        if snap is None or snap.generation != generation:
+            with self._cache_lock:
+                snap = self._snapshot
+                if snap is None or snap.generation != generation:
+                    snap = Snapshot(generation, self._load_all())
+                    self._snapshot = snap
+        return snap
+
+    def items(self):
+        return self.snapshot().docs.items()
+
+    def values(self):
+        return self.snapshot().values
+
+    def __len__(self):
+        return len(self.snapshot().docs)
+
+    def find_page(self, where=None, prefix=None, order_by=(), desc=False, after=None, limit=50):
+        # one page of find() rows, plus the after of the next page (None on the last)
+        rows = self.find(where, prefix, order_by, desc, after, limit + 1)
+        if len(rows) <= limit:
+            return rows, None
+        key, doc = rows[limit - 1]
+        return rows[:limit], [*(_column(key, doc, c) for c in order_by), key]
+
+
+def _sort_value(value):
+    # mixed types sort the way sqlite sorts them, None then numbers then
+    # text, so values of different types are never compared with each other
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    return (2, str(value))
+
+
+def _column(key, doc, column):
+    if column == "key":
+        return key
+    return doc.get(column) if isinstance(doc, dict) else None
+
+
+def _row_key(row, order):
+    return tuple(_sort_value(_column(*row, c)) for c in order)
+
+
+# ---- json file layouts ----
+# videos.json is a list of videos, users.json is a dict keyed by username and
+# admins.json is {"admins": [...], "moderators": [...]}. Anything newer is a
+# plain dict keyed by the document key.
+
+def _decode_list(raw):
+    return {doc["id"]: doc for doc in raw}
+
+def _encode_list(docs):
+    return list(docs.values())
+
+def _decode_dict(raw):
+    return dict(raw)
+
+def _encode_dict(docs):
+    return docs
+
+ROLE_LISTS = {"admin": "admins", "moderator": "moderators"}
+
+def _decode_roles(raw):
+    docs = {}
+    for role, list_name in ROLE_LISTS.items():
+        for username in raw.get(list_name, []):
+            docs[f"{role}:{username}"] = {"role": role, "username": username}
+    return docs
+
+def _encode_roles(docs):
+    raw = {list_name: [] for list_name in ROLE_LISTS.values()}
+    for doc in docs.values():
+        raw[ROLE_LISTS[doc["role"]]].append(doc["username"])
+    return raw
+
+JSON_LAYOUTS = {
+    "videos": ("videos.json", _decode_list, _encode_list),
+    "users": ("users.json", _decode_dict, _encode_dict),
+    "roles": ("admins.json", _decode_roles, _encode_roles),
+}
+
+
+class JsonCollection(CachedCollection):
+    def __init__(self, store, name):
+        filename, self.decode, self.encode = JSON_LAYOUTS.get(
+            name, (f"{name}.json", _decode_dict, _encode_dict)
+        )
+        self.store = store
+        self.name = name
+        self.path = os.path.join(store.root, filename)
+        self.lock = FileLock(self.path + ".lock")
+        self._cache_lock = threading.Lock()
+        self._writes = 0
+
+    def generation(self):
+        # our own writes bump _writes, anyone else's show up in stat()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return (self._writes, None)
+        return (self._writes, st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return self.decode(json.load(f))
+
+    def _load_all(self):
+        return self._read().items()
+
+    def _write(self, docs):
+        atomic_write_json(self.path, self.encode(docs))
+        self._writes += 1
+
+    def get(self, key):
+        return thaw(self.snapshot().docs.get(key))
+
+    # every write re-reads the file under the lock, so two workers editing
+    # different records can't drop each other's changes
+
+    def put(self, key, doc):
+        with self.lock:
+            docs = self._read()
+            docs[key] = doc
+            self._write(docs)
+
+    def delete(self, key):
+        with self.lock:
+            docs = self._read()
+            if docs.pop(key, None) is not None:
+                self._write(docs)
+
+    def update_many(self, keys, fn):
+        # fn(key, doc) edits doc in place, missing keys are skipped. Takes the
+        # store lock like the sqlite backend's transaction, a handler holding
+        # it may have read these docs and be about to put them back.
+        with self.store.transaction(), self.lock:
+            docs = self._read()
+            for key in keys:
+                if key in docs:
+                    fn(key, docs[key])
+            self._write(docs)
+
+    def put_many(self, items):
+        with self.lock:
+            docs = self._read()
+            docs.update(items)
+            self._write(docs)
+
+    def delete_many(self, keys):
+        with self.lock:
+            docs = self._read()
+            for key in keys:
+                docs.pop(key, None)
+            self._write(docs)
+
+    def replace(self, docs):
+        with self.lock:
+            self._write(thaw(dict(docs)))
+
+    # the json backend has no real indexes. Plain sorted listings are sorted
+    # once per snapshot and paged with bisect, filtered queries scan it.
+
+    def _sorted(self, snap, order):
+        if order not in snap.sorted:
+            rows = sorted(snap.docs.items(), key=lambda r: _row_key(r, order))
+            snap.sorted[order] = (rows, [_row_key(r, order) for r in rows])
+        return snap.sorted[order]
+
+    def find(self, where=None, prefix=None, order_by=(), desc=False, after=None, limit=None):
+        snap = self.snapshot()
+        order = (*order_by, "key")
+        after_key = tuple(_sort_value(v) for v in after) if after is not None else None
+        if not where and not prefix:
+            rows, keys = self._sorted(snap, order)
+            if desc:
+                end = bisect_left(keys, after_key) if after_key is not None else len(rows)
+                return rows[max(0, end - limit) if limit else 0:end][::-1]
+            start = bisect_right(keys, after_key) if after_key is not None else 0
+            return rows[start:start + limit] if limit else rows[start:]
+
+        rows = snap.docs.items()
+        keys = (where or {}).get("key")
+        if isinstance(keys, (list, tuple)):
+            # straight to the docs asked for
+            rows = [(k, snap.docs[k]) for k in dict.fromkeys(keys) if k in snap.docs]
+        for column, value in (where or {}).items():
+            if isinstance(value, (list, tuple)):
+                values = set(value)
+                rows = [(k, d) for k, d in rows if _column(k, d, column) in values]
+            else:
+                rows = [(k, d) for k, d in rows if _column(k, d, column) == value]
+        if prefix:
+            column, text = prefix
+            rows = [(k, d) for k, d in rows if str(_column(k, d, column) or "").startswith(text)]
+        rows = sorted(rows, key=lambda r: _row_key(r, order), reverse=desc)
+        if after_key is not None:
+            rows = [r for r in rows if (_row_key(r, order) < after_key if desc else _row_key(r, order) > after_key)]
+        return rows[:limit] if limit else rows
+
+    def count(self, where=None):
+        return len(self.find(where)) if where else len(self)
+
+
+class JsonStore:
+    backend = "json"
+
+    def __init__(self, root="."):
+        self.root = root
+        self._collections = {}
+        self._lock = FileLock(os.path.join(root, ".eniv.lock"))
+
+    def collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = JsonCollection(self, name)
+        return self._collections[name]
+
+    def transaction(self):
+        # one lock for the whole store, the flat files can't do better. Single
+        # writes only take their collection's lock, always after this one.
+        return self._lock
+
+    def get_meta(self, key):
+        return self.collection("meta").get(key)
+
+    def set_meta(self, key, value):
+        self.collection("meta").put(key, value)
+
+
+class SqliteCollection(CachedCollection):
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.columns = COLUMNS.get(name, ())
+        self._cache_lock = threading.Lock()
+
+    def generation(self):
+        row = self.store.conn().execute(
+            "SELECT value FROM generations WHERE name = ?", (self.name,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _bump(self):
+        # every write bumps the generation so all workers drop their snapshot
+        self.store.conn().execute(
+            "INSERT INTO generations (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (self.name,),
+        )
+
+    def _load_all(self):
+        rows = self.store.conn().execute(f"SELECT key, data FROM {self.name} ORDER BY rowid")
+        return [(key, json.loads(data)) for key, data in rows]
+
+    def _row(self, key, doc):
+        return [key, json.dumps(doc, ensure_ascii=False)] + [
+            doc.get(c) if isinstance(doc, dict) else None for c in self.columns
+        ]
+
+    def get(self, key):
+        row = self.store.conn().execute(
+            f"SELECT data FROM {self.name} WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, doc):
+        cols = ["key", "data", *self.columns]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in cols[1:])
+        self.store.conn().execute(
+            f"INSERT INTO {self.name} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT(key) DO UPDATE SET {updates}",
+            self._row(key, doc),
+        )
+        self._bump()
+
+    def delete(self, key):
+        self.store.conn().execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+        self._bump()
+
+    def update_many(self, keys, fn):
+        # fn(key, doc) edits doc in place, missing keys are skipped
+        with self.store.transaction():
+            for key in keys:
+                doc = self.get(key)
+                if doc is not None:
+                    fn(key, doc)
+                    self.put(key, doc)
+
+    def put_many(self, items):
+        with self.store.transaction():
+            for key, doc in dict(items).items():
+                self.put(key, doc)
+
+    def delete_many(self, keys):
+        with self.store.transaction():
+            self.store.conn().executemany(
+                f"DELETE FROM {self.name} WHERE key = ?", [(key,) for key in keys]
+            )
+            self._bump()
+
+    def _where(self, where, prefix, order, desc, after):
+        clauses, params = [], []
+        for column, value in (where or {}).items():
+            if isinstance(value, (list, tuple)):
+                clauses.append(f"{column} IN ({', '.join('?' * len(value))})")
+                params += list(value)
+            else:
+                clauses.append(f"{column} IS ?")
+                params.append(value)
+        if prefix:
+            column, text = prefix
+            clauses.append(f"{column} >= ? AND {column} < ?")
+            params += [text, text + "\U0010ffff"]
+        if after is not None:
+            clauses.append(
+                f"({', '.join(order)}) {'<' if desc else '>'} ({', '.join('?' * len(order))})"
+            )
+            params += list(after)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def find(self, where=None, prefix=None, order_by=(), desc=False, after=None, limit=None):
+        order = [*order_by, "key"]
+        sql, params = self._where(where, prefix, order, desc, after)
+        direction = " DESC" if desc else ""
+        sql = f"SELECT key, data FROM {self.name}{sql} ORDER BY " + ", ".join(c + direction for c in order)
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [(key, freeze(json.loads(data))) for key, data in self.store.conn().execute(sql, params)]
+
+    def count(self, where=None):
+        sql, params = self._where(where, None, (), False, None)
+        return self.store.conn().execute(f"SELECT COUNT(*) FROM {self.name}{sql}", params).fetchone()[0]
+
+    def replace(self, docs):
+        docs = dict(docs)
+        with self.store.transaction():
+            conn = self.store.conn()
+            stale = [(k,) for (k,) in conn.execute(f"SELECT key FROM {self.name}") if k not in docs]
+            conn.executemany(f"DELETE FROM {self.name} WHERE key = ?", stale)
+            for key, doc in docs.items():
+                self.put(key, doc)
+
+
+class SqliteStore:
+    backend = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._collections = {}
+        conn = self.conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, value INTEGER)")
+        for name in COLUMNS:
+            self._create_table(conn, name)
+
+    def conn(self):
+        # one connection per thread, sqlite connections can't be shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def _create_table(self, conn, name):
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {name} (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({name})")}
+        for column in COLUMNS.get(name, ()):
+            if column not in existing:
+                # new column on an old database, backfill it from the documents
+                conn.execute(f"ALTER TABLE {name} ADD COLUMN {column}")
+                conn.execute(f"UPDATE {name} SET {column} = json_extract(data, '$.{column}')")
+        for index in INDEXES.get(name, ()):
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {name}_{'_'.join(index)} ON {name} ({', '.join(index)})"
+            )
+
+    def collection(self, name):
+        if name not in self._collections:
+            self._create_table(self.conn(), name)
+            self._collections[name] = SqliteCollection(self, name)
+        return self._collections[name]
+
+    @contextmanager
+    def transaction(self):
+        conn = self.conn()
+        if self._local.depth:
+            # nested, the outer transaction commits
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def get_meta(self, key):
+        row = self.conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.conn().execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
+def open_store(backend, db_file, root="."):
+    if backend == "json":
+        store = JsonStore(root)
+    elif backend == "sqlite":
+        store = SqliteStore(db_file)
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    store.videos = store.collection("videos")
+    store.users = store.collection("users")
+    store.roles = store.collection("roles")
+    return store
+
+
+# ------------------------------
+# Migration
+# ------------------------------
+def import_json(store, root="."):
+    # copy videos.json / users.json / admins.json into the store
+    source = JsonStore(root)
+    counts = {}
+    with store.transaction():
+        for name in ("videos", "users", "roles"):
+            items = source.collection(name).items()
+            store.collection(name).replace(items)
+            counts[name] = len(items)
+        store.set_meta("json_imported", datetime.utcnow().isoformat())
+    return counts
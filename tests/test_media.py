@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+# The media store's reference counting, against the app's own store in a
+# scratch directory (its folders and eniv.db are relative to the cwd).
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("eniv"))
+    os.environ.setdefault("ENIV_STORAGE", "sqlite")
+    import app
+    yield app
+    os.chdir(cwd)
+
+
+def publish(folder, name, data=b"png"):
+    with open(os.path.join(folder, name), "wb") as f:
+        f.write(data)
+    return name
+
+
+def test_release_keeps_files_another_entry_uses(app):
+    # two different uploads whose encodes gave byte-identical thumbnails
+    thumbnail = publish(app.THUMB_FOLDER, "same.png")
+    app.acquire_media("upload-a", "video-a", thumbnail=thumbnail)
+    app.acquire_media("upload-b", "video-b", thumbnail=thumbnail)
+
+    app.release_media("upload-a", "video-a")
+    assert app.media_files.get("upload-a") is None
+    assert os.path.exists(os.path.join(app.THUMB_FOLDER, thumbnail))
+
+    app.release_media("upload-b", "video-b")
+    assert app.media_files.get("upload-b") is None
+    assert not os.path.exists(os.path.join(app.THUMB_FOLDER, thumbnail))
+
+
+def test_release_keeps_files_until_the_last_video(app):
+    video = publish(app.VIDEO_FOLDER, "clip.mp4")
+    app.acquire_media("upload-c", "video-c1", video=video)
+    app.acquire_media("upload-c", "video-c2")
+
+    app.release_media("upload-c", "video-c1")
+    assert os.path.exists(os.path.join(app.VIDEO_FOLDER, video))
+    app.release_media("upload-c", "video-c2")
+    assert not os.path.exists(os.path.join(app.VIDEO_FOLDER, video))
+
+
+def test_release_leaves_processing_entries(app):
+    app.acquire_media("upload-d", "video-d", status="processing")
+    app.release_media("upload-d", "video-d")
+    assert app.media_files.get("upload-d")["videos"] == []
+
+
+def failed_encode(*args, **kwargs):
+    raise RuntimeError("encode failed")
+
+
+@pytest.mark.parametrize("ext", [".webm", ".mov", ".mp4"])
+def test_raw_fallback_keeps_the_upload_extension(app, monkeypatch, ext):
+    monkeypatch.setattr(app.media, "transcode", failed_encode)
+    monkeypatch.setattr(app.media, "make_thumbnail", failed_encode)
+    media_hash = f"raw{ext[1:]}"
+    temp_path = os.path.join(app.UPLOAD_TEMP_FOLDER, publish(app.UPLOAD_TEMP_FOLDER, media_hash + ext, ext.encode()))
+    app.acquire_media(media_hash, f"video-{media_hash}", status="processing")
+    job = {"payload": {"media": media_hash, "temp_path": temp_path, "probe": {}}, "attempt": 3, "max_attempts": 3}
+
+    app.process_upload(job, lambda stage: None)
+    entry = app.media_files.get(media_hash)
+    assert entry["status"] == "ready"
+    assert entry["video"].endswith(ext)
+    assert os.path.exists(os.path.join(app.VIDEO_FOLDER, entry["video"]))
+    assert not [name for name in os.listdir(app.VIDEO_FOLDER) if name.startswith(f"{media_hash}.work")]
+
+
+def test_raw_fallback_picked_up_after_a_restart(app, monkeypatch):
+    # the upload was moved into place, then the process died before publishing
+    monkeypatch.setattr(app.media, "make_thumbnail", failed_encode)
+    publish(app.VIDEO_FOLDER, "restarted.work.mkv", b"raw mkv")
+    app.acquire_media("restarted", "video-restarted", status="processing")
+    job = {"payload": {"media": "restarted", "temp_path": os.path.join(app.UPLOAD_TEMP_FOLDER, "restarted.mkv")},
+           "attempt": 1, "max_attempts": 3}
+
+    app.process_upload(job, lambda stage: None)
+    assert app.media_files.get("restarted")["video"].endswith(".mkv")
@@ -0,0 +1,131 @@
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+import probe
+
+# MP4s are put together box by box: ftyp, moov with a video and a sound
+# track, and an mdat of filler bytes, in either order.
+
+
+def box(kind, *payload):
+    data = b"".join(payload)
+    return struct.pack(">I4s", 8 + len(data), kind) + data
+
+
+def full_box(kind, *payload, version=0):
+    return box(kind, struct.pack(">B3x", version), *payload)
+
+
+def header(kind, timescale, duration, version=0):
+    # mvhd and mdhd: times, timescale, duration, then fields probe doesn't read
+    if version == 1:
+        times = struct.pack(">QQIQ", 0, 0, timescale, duration)
+    else:
+        times = struct.pack(">IIII", 0, 0, timescale, duration)
+    return full_box(kind, times, bytes(80), version=version)
+
+
+def track(handler, codec, timescale, duration, width=0, height=0):
+    tkhd = full_box(b"tkhd", bytes(76), struct.pack(">II", width << 16, height << 16))
+    hdlr = full_box(b"hdlr", bytes(4), handler, bytes(12), b"\0")
+    stsd = full_box(b"stsd", struct.pack(">I", 1), box(codec, bytes(8)))
+    stbl = box(b"stbl", stsd)
+    mdia = box(b"mdia", header(b"mdhd", timescale, duration), hdlr, box(b"minf", stbl))
+    return box(b"trak", tkhd, mdia)
+
+
+def mp4(moov_at_end=False, mvhd_version=0, mvhd_duration=None, mdat_size=4096):
+    ftyp = box(b"ftyp", b"isom", struct.pack(">I", 512), b"isomavc1")
+    moov = box(
+        b"moov",
+        header(b"mvhd", 1000, 12500 if mvhd_duration is None else mvhd_duration, version=mvhd_version),
+        track(b"vide", b"avc1", 12800, 160000, 640, 360),
+        track(b"soun", b"mp4a", 44100, 551250),
+    )
+    mdat = box(b"mdat", bytes(mdat_size))
+    return ftyp + (mdat + moov if moov_at_end else moov + mdat)
+
+
+EXPECTED = {"format": "mp4", "duration": 12.5, "width": 640, "height": 360,
+            "video_codec": "avc1", "audio_codec": "mp4a"}
+
+
+@pytest.fixture
+def write(tmp_path):
+    def write(data, name="clip.mp4"):
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+    return write
+
+
+@pytest.mark.parametrize("moov_at_end", [False, True])
+def test_probe_video_reads_mp4_headers(write, moov_at_end):
+    path = write(mp4(moov_at_end=moov_at_end))
+    assert probe.probe_video(path) == EXPECTED
+    assert probe.probe_partial(path) == EXPECTED
+
+
+def test_probe_video_64_bit_mvhd(write):
+    assert probe.probe_video(write(mp4(mvhd_version=1)))["duration"] == 12.5
+
+
+def test_probe_video_falls_back_to_track_durations(write):
+    # no movie duration, the longest track's is used
+    assert probe.probe_video(write(mp4(mvhd_duration=0)))["duration"] == 12.5
+
+
+def test_probe_partial_moov_first_only_needs_the_header(write):
+    data = mp4()
+    assert probe.probe_partial(write(data[:len(data) - 4000])) == EXPECTED
+
+
+def test_probe_partial_moov_first_cut_inside_the_header(write):
+    data = mp4()
+    assert probe.probe_partial(write(data[:200])) is None
+
+
+def test_probe_partial_moov_at_end_not_there_yet(write):
+    data = mp4(moov_at_end=True)
+    assert probe.probe_partial(write(data[:len(data) // 2])) is None
+    assert probe.probe_partial(write(data[:len(data) - 10])) is None
+
+
+def test_probe_partial_not_mp4(write):
+    assert probe.probe_partial(write(b"\x1aE\xdf\xa3" + bytes(100), "clip.webm")) is None
+    assert probe.probe_partial(write(b"")) is None
+
+
+def test_probe_video_truncated_file_is_an_error(write):
+    data = mp4(moov_at_end=True)
+    with pytest.raises(probe.ProbeError):
+        probe.probe_video(write(data[:len(data) // 2]))
+
+
+def test_probe_video_corrupt_box_is_an_error(write):
+    data = mp4()
+    # a moov claiming to be smaller than its own header
+    corrupt = data.replace(data[32:40], struct.pack(">I4s", 4, b"moov"), 1)
+    with pytest.raises(probe.ProbeError):
+        probe.probe_video(write(corrupt))
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg") or not shutil.which("ffprobe"), reason="needs ffmpeg")
+@pytest.mark.parametrize("faststart", [False, True])
+def test_probe_video_matches_ffprobe(tmp_path, faststart):
+    # a real encode, ffmpeg writes the moov at the end unless told otherwise
+    path = str(tmp_path / "clip.mp4")
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=25:duration=2",
+         "-f", "lavfi", "-i", "sine=duration=2", "-c:v", "libx264", "-c:a", "aac", "-shortest",
+         *(["-movflags", "+faststart"] if faststart else []), path],
+        check=True,
+    )
+    info = probe.probe_video(path)
+    reference = probe._probe_ffprobe(path)
+    assert (info["width"], info["height"]) == (reference["width"], reference["height"]) == (320, 240)
+    assert info["video_codec"] == "avc1" and info["audio_codec"] == "mp4a"
+    assert info["duration"] == pytest.approx(reference["duration"], abs=0.1)
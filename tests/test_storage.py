@@ -0,0 +1,117 @@
+import pytest
+
+import storage
+
+# The same find() cases against both backends, on the notifications
+# collection: user, from_user, timestamp and read are its columns.
+
+DOCS = {
+    "ann|1": {"user": "ann", "from_user": "bob", "timestamp": "2026-01-01", "read": False},
+    "ann|2": {"user": "ann", "from_user": "cat", "timestamp": "2026-01-03", "read": True},
+    "ann|3": {"user": "ann", "from_user": None, "timestamp": "2026-01-02", "read": False},
+    "ann|4": {"user": "ann", "from_user": "bob", "timestamp": "2026-01-02", "read": True},
+    "bob|1": {"user": "bob", "from_user": "ann", "timestamp": "2026-01-05", "read": False},
+    "bobby|1": {"user": "bobby", "from_user": "ann", "timestamp": "2026-01-04", "read": False},
+}
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def notifications(request, tmp_path):
+    if request.param == "json":
+        store = storage.JsonStore(str(tmp_path))
+    else:
+        store = storage.SqliteStore(str(tmp_path / "eniv.db"))
+    collection = store.collection("notifications")
+    collection.put_many(DOCS)
+    return collection
+
+
+def keys(rows):
+    return [key for key, _ in rows]
+
+
+def test_find_everything_in_key_order(notifications):
+    assert keys(notifications.find()) == sorted(DOCS)
+
+
+def test_find_where(notifications):
+    assert keys(notifications.find(where={"user": "ann", "from_user": "bob"})) == ["ann|1", "ann|4"]
+    assert keys(notifications.find(where={"user": "nobody"})) == []
+
+
+def test_find_where_none_and_bool(notifications):
+    assert keys(notifications.find(where={"from_user": None})) == ["ann|3"]
+    assert keys(notifications.find(where={"user": "ann", "read": False})) == ["ann|1", "ann|3"]
+    assert keys(notifications.find(where={"read": True})) == ["ann|2", "ann|4"]
+
+
+def test_find_where_any_of(notifications):
+    assert keys(notifications.find(where={"key": ["bob|1", "ann|2", "nope"]})) == ["ann|2", "bob|1"]
+    assert keys(notifications.find(where={"user": ("bob", "bobby")})) == ["bobby|1", "bob|1"]
+    assert keys(notifications.find(where={"key": []})) == []
+    assert notifications.count(where={"from_user": ["bob", "cat"]}) == 3
+
+
+def test_find_prefix(notifications):
+    assert keys(notifications.find(prefix=("user", "bob"))) == ["bobby|1", "bob|1"]
+    assert keys(notifications.find(where={"read": False}, prefix=("user", "bobb"))) == ["bobby|1"]
+
+
+def test_find_order_by_breaks_ties_on_key(notifications):
+    rows = notifications.find(where={"user": "ann"}, order_by=("timestamp",))
+    assert keys(rows) == ["ann|1", "ann|3", "ann|4", "ann|2"]
+    rows = notifications.find(where={"user": "ann"}, order_by=("timestamp",), desc=True)
+    assert keys(rows) == ["ann|2", "ann|4", "ann|3", "ann|1"]
+
+
+def test_find_limit(notifications):
+    assert keys(notifications.find(order_by=("timestamp",), limit=2)) == ["ann|1", "ann|3"]
+    assert keys(notifications.find(order_by=("timestamp",), desc=True, limit=2)) == ["bob|1", "bobby|1"]
+
+
+@pytest.mark.parametrize("desc", [False, True])
+def test_find_after_pages_through_everything_once(notifications, desc):
+    seen, after = [], None
+    while True:
+        rows = notifications.find(order_by=("timestamp",), desc=desc, after=after, limit=2)
+        if not rows:
+            break
+        seen += keys(rows)
+        key, doc = rows[-1]
+        after = [doc["timestamp"], key]
+    assert seen == keys(notifications.find(order_by=("timestamp",), desc=desc))
+    assert len(seen) == len(DOCS)
+
+
+def test_find_after_with_where(notifications):
+    rows = notifications.find(where={"user": "ann"}, order_by=("timestamp",), desc=True,
+                              after=["2026-01-02", "ann|4"])
+    assert keys(rows) == ["ann|3", "ann|1"]
+
+
+def test_find_page(notifications):
+    rows, after = notifications.find_page(where={"user": "ann"}, order_by=("timestamp",), limit=3)
+    assert keys(rows) == ["ann|1", "ann|3", "ann|4"]
+    assert after == ["2026-01-02", "ann|4"]
+    rows, after = notifications.find_page(where={"user": "ann"}, order_by=("timestamp",), after=after, limit=3)
+    assert keys(rows) == ["ann|2"]
+    assert after is None
+
+
+def test_count(notifications):
+    assert notifications.count() == len(DOCS)
+    assert notifications.count(where={"user": "ann", "read": False}) == 2
+
+
+def test_results_are_read_only(notifications):
+    _, doc = notifications.find(limit=1)[0]
+    with pytest.raises(TypeError):
+        doc["read"] = True
+
+
+def test_find_orders_numbers_as_numbers(notifications):
+    videos = notifications.store.collection("videos")
+    videos.put_many({vid: {"id": vid, "uploader": "ann", "views": views}
+                     for vid, views in (("a", 9), ("b", 10), ("c", 100), ("d", None))})
+    assert keys(videos.find(order_by=("views",), desc=True)) == ["c", "b", "a", "d"]
+    assert keys(videos.find(order_by=("views",), after=[9, "a"])) == ["b", "c"]
@@ -0,0 +1,56 @@
+# ------------------------------
+# Username lookups
+# ------------------------------
+# Two small indexes over the users, kept in step by save_user() and
+# remove_user():
+#   "user_names"  casefolded username -> the usernames spelled that way
+#   "user_hints"  casefolded recovery hint -> the usernames using it
+# Both are keyed "<casefolded value>|<username>", so one user is one row and
+# a lookup is a single indexed query.
+
+
+class UsernameIndex:
+    def __init__(self, names, hints):
+        self.names = names
+        self.hints = hints
+
+    def add(self, username, hint=""):
+        name_key = f"{username.casefold()}|{username}"
+        if not self.names.get(name_key):
+            self.names.put(name_key, {"name_key": username.casefold(), "username": username})
+        hint = (hint or "").strip().casefold()
+        stale = [key for key, doc in self.hints.find(where={"username": username}) if doc["hint_key"] != hint]
+        if stale:
+            self.hints.delete_many(stale)
+        if hint and not self.hints.get(f"{hint}|{username}"):
+            self.hints.put(f"{hint}|{username}", {"hint_key": hint, "username": username})
+
+    def remove(self, username):
+        self.names.delete(f"{username.casefold()}|{username}")
+        keys = [key for key, _ in self.hints.find(where={"username": username})]
+        if keys:
+            self.hints.delete_many(keys)
+
+    def canonical(self, name):
+        # the username name refers to ignoring case, None if there's none
+        # (an exact match wins when several differ only in case)
+        matches = [doc["username"] for _, doc in self.names.find(where={"name_key": name.casefold()})]
+        if name in matches:
+            return name
+        return matches[0] if matches else None
+
+    def with_hint(self, hint):
+        hint = hint.strip().casefold()
+        if not hint:
+            return []
+        return [doc["username"] for _, doc in self.hints.find(where={"hint_key": hint})]
+
+    def rebuild(self, users):
+        names, hints = {}, {}
+        for username, user in users.items():
+            names[f"{username.casefold()}|{username}"] = {"name_key": username.casefold(), "username": username}
+            hint = (user.get("hint") or "").strip().casefold()
+            if hint:
+                hints[f"{hint}|{username}"] = {"hint_key": hint, "username": username}
+        self.names.replace(names)
+        self.hints.replace(hints)
@@ -0,0 +1,84 @@
+# ------------------------------
+# Likes and dislikes
+# ------------------------------
+# One row per (target, user) in the "votes" collection, value 1 for a like
+# and -1 for a dislike. Targets are "video:<id>" or "comment:<id>", and
+# every row carries the video it belongs to as its scope, so a viewer's votes
+# on one video page are a single indexed lookup. The like/dislike totals
+# live on the voted-on record itself, kept up to date with count().
+
+LIKE = 1
+DISLIKE = -1
+
+
+def video_target(video_id):
+    return f"video:{video_id}"
+
+
+def comment_target(comment_id):
+    return f"comment:{comment_id}"
+
+
+def count(doc, old, new):
+    # move doc's likes/dislikes from vote old to vote new (0 = no vote)
+    doc["likes"] = doc.get("likes", 0) + (new == LIKE) - (old == LIKE)
+    doc["dislikes"] = doc.get("dislikes", 0) + (new == DISLIKE) - (old == DISLIKE)
+
+
+class VoteStore:
+    def __init__(self, collection):
+        self.votes = collection
+
+    def get(self, target, user):
+        if not user:
+            return 0
+        row = self.votes.get(f"{target}|{user}")
+        return row["value"] if row else 0
+
+    def toggle(self, target, user, value, scope):
+        # voting the same way twice takes the vote back, returns (old, new)
+        key = f"{target}|{user}"
+        row = self.votes.get(key)
+        old = row["value"] if row else 0
+        new = 0 if old == value else value
+        if new:
+            self.votes.put(key, {"target": target, "user": user, "scope": scope, "value": new})
+        else:
+            self.votes.delete(key)
+        return old, new
+
+    def user_votes(self, user, scope):
+        # {target: value} for everything user voted on under scope
+        if not user:
+            return {}
+        return {row["target"]: row["value"] for _, row in self.votes.find(where={"user": user, "scope": scope})}
+
+    def overlay(self, user, scope, kind="comment"):
+        # (liked ids, disliked ids) of user's votes on kind targets under
+        # scope, for marking a page without touching the records themselves
+        liked, disliked = set(), set()
+        prefix = f"{kind}:"
+        for target, value in self.user_votes(user, scope).items():
+            if target.startswith(prefix):
+                (liked if value == LIKE else disliked).add(target[len(prefix):])
+        return liked, disliked
+
+    def remove_targets(self, targets):
+        # forget every vote on targets (deleted comments)
+        keys = [key for target in targets for key, _ in self.votes.find(where={"target": target})]
+        if keys:
+            self.votes.delete_many(keys)
+
+    def remove_scope(self, scope):
+        keys = [key for key, _ in self.votes.find(where={"scope": scope})]
+        if keys:
+            self.votes.delete_many(keys)
+
+    def import_lists(self, target, scope, liked_by, disliked_by):
+        # rows for the old liked_by/disliked_by lists
+        rows = {}
+        for value, users in ((LIKE, liked_by), (DISLIKE, disliked_by)):
+            for user in users:
+                rows[f"{target}|{user}"] = {"target": target, "user": user, "scope": scope, "value": value}
+        if rows:
+            self.votes.put_many(rows)